@@ -3,31 +3,53 @@ import logging
 import os
 import sys
 import argparse
+import heapq
 import os
 import time
 
-from multiprocessing import Lock, Event
-from signal import signal, SIGTERM, SIGINT, SIGCHLD
+from multiprocessing import Event
+from signal import signal, pthread_sigmask, SIGTERM, SIGINT, SIGHUP, SIG_BLOCK, SIG_UNBLOCK
 
 import chronos
+from chronos import metrics, policy
 from chronos.config import config
-from chronos.database import Database
-from chronos.worker import Worker
+from chronos.database import Database, summary_fold_batch, summary_fold_interval
+from chronos.locks import LockAccounting, lease_check_interval, reconcile_interval
+from chronos.notify import Listener, Wakeup, idle_timeout, notify
+from chronos.retention import Retention
+from chronos.worker import Worker, node
 
 sys.dont_write_bytecode = True
 
 workers = []
 exit = Event()
-lock = Lock()
-
-def worker_died(signum, frame):
-    if not exit.is_set():
-        logging.warning("worker quit unexpectidly, spawning new worker")
-        spawn_worker()
+wakeup = Wakeup()
+
+# replaces workers that quit, checked from the lock manager loop
+# returns the number of workers replaced
+def replace_dead_workers(db):
+    replaced = 0
+    for worker in list(workers):
+        if not worker.is_alive():
+            logging.warning("worker quit unexpectidly, spawning new worker")
+            workers.remove(worker)
+            # every task the worker had claimed would otherwise stay running and locked until the next restart
+            requeued = db.queue_worker_tasks(node, worker.pid)
+            if requeued > 0:
+                logging.warning("requeued {} tasks of worker {}".format(requeued, worker.pid))
+            spawn_worker()
+            replaced += 1
+    return replaced
 
 def spawn_worker():
-    worker = Worker(lock)
-    worker.start()
+    # a hangup arriving before the worker installs its handler would kill it, so the worker starts with
+    # hangups blocked and unblocks them once its handler is in place
+    pthread_sigmask(SIG_BLOCK, {SIGHUP})
+    try:
+        worker = Worker(wakeup)
+        worker.start()
+    finally:
+        pthread_sigmask(SIG_UNBLOCK, {SIGHUP})
     workers.append(worker)
     logging.debug("worker {} started".format(worker.pid))
 
@@ -159,41 +181,126 @@ shutdown = False
 def handler(signum, frame):
     global shutdown
     shutdown = True
+    # interrupt the lock manager if it is waiting for events
+    notify("shutdown")
+
+def reload_handler(signum, frame):
+    # swap in new lock policies here and in every worker, leases and running tasks are untouched
+    policy.reload()
+    for worker in workers:
+        try:
+            os.kill(worker.pid, SIGHUP)
+        except Exception as e:
+            logging.warning("unable to signal worker {}: {}".format(worker.pid, e))
+    notify("reload")
 
 signal(SIGTERM, handler)
 signal(SIGINT, handler)
+signal(SIGHUP, reload_handler)
+
+# (time, lock_type) of delayed tasks that have not become due yet
+scheduled = []
+
+# held locks per lock type, recounted from the database every reconcile_interval
+accounting = LockAccounting()
+next_reconcile = 0
+next_lease_check = 0
+retention = None
+next_summary_fold = 0
+
+# set when there are tasks a worker can claim, idle workers are only woken then
+claimable = True
 
 try:
-    with Database() as db:
-        # requeue any tasks that were left in the running state
-        db.queue_running_tasks()
+    with Database() as db, Listener() as listener:
+        # requeue any tasks this node left in the running state
+        db.queue_running_tasks(node)
 
         # spawn configured number of threads
         for index in range(config.getint("chronos", "num_workers")):
             logging.info("starting worker")
             spawn_worker()
 
+        # archiving finished tasks and checking the status counts run beside the lock manager instead of inside its loop
+        retention = Retention()
+        retention.start()
+
         # manage locks
         while not shutdown:
             try:
-                locks = db.select_locks()
-                if not locks:
-                    time.sleep(1)
-                    continue
-
-                for l in locks:
-                    # get lock info
-                    lock_type = l[0]
-                    lock_count = l[1]
-
-                    # determine max number locks allowed for this lock_type
-                    max_locks = config.getint("lock_type_default", "max_locks")
-                    if config.has_option("lock_type_{}".format(lock_type), "max_locks"):
-                        max_locks = config.getint("lock_type_{}".format(lock_type), "max_locks")
-
-                    # lock as many tasks of this lock type as needed to use all available locks
-                    if lock_count < max_locks:
-                        db.lock_oldest(lock_type, max_locks - lock_count)
+                # the tasks of a dead worker are handed back, recount the locks they hold
+                if replace_dead_workers(db) > 0:
+                    next_reconcile = 0
+                    claimable = True
+
+                if time.time() >= next_reconcile:
+                    accounting.reconcile(db)
+                    next_reconcile = time.time() + reconcile_interval
+
+                # free the locks of clients that stopped keeping their lease alive
+                if time.time() >= next_lease_check:
+                    accounting.expire(db, lambda lock_type: policy.get(lock_type).timeout)
+                    next_lease_check = time.time() + lease_check_interval
+
+                # lock as many tasks of each waiting lock type as needed to use all available locks
+                for lock_type in list(accounting.waiting):
+                    if accounting.lock(db, lock_type, policy.get(lock_type).max_locks) > 0:
+                        claimable = True
+
+                # let idle workers pick up newly locked or due tasks
+                if claimable:
+                    wakeup.notify()
+                    claimable = False
+                metrics.flush()
+
+                # bring the status counts shown by the web service up to date, right away again while there is a backlog
+                if time.time() >= next_summary_fold:
+                    more = db.fold_summary(summary_fold_batch) >= summary_fold_batch
+                    next_summary_fold = time.time() + (0 if more else summary_fold_interval)
+
+                # wait until a task is created, delayed or finished, or a delayed task becomes due
+                timeout = min(idle_timeout, next_lease_check - time.time(), next_summary_fold - time.time())
+                if scheduled:
+                    timeout = min(timeout, scheduled[0][0] - time.time())
+                for event in listener.wait(timeout):
+                    lock_type = event.get("lock_type")
+                    if event.get("event") == "insert":
+                        if lock_type is None:
+                            next_reconcile = 0
+                        else:
+                            accounting.ready(lock_type)
+                    elif event.get("event") == "unlock":
+                        # releases from outside a worker do not know the lock type, recount instead
+                        if lock_type is None:
+                            next_reconcile = 0
+                        else:
+                            accounting.unlock(lock_type)
+                    elif event.get("event") == "release":
+                        # a busy worker handed back tasks it claimed
+                        claimable = True
+                    elif event.get("event") == "reload":
+                        # limits may have been raised so every lock type could have room now
+                        accounting.waiting.update(accounting.held)
+                    elif event.get("event") == "delay":
+                        if event.get("unlock"):
+                            if lock_type is None:
+                                next_reconcile = 0
+                            else:
+                                accounting.unlock(lock_type)
+                        # unlocked tasks need a new lock once they are due, locked ones just need a worker
+                        if len(scheduled) < 10000:
+                            due = time.time() + float(event.get("seconds", 0))
+                            heapq.heappush(scheduled, (due, (lock_type or "") if event.get("unlock") else ""))
+
+                # delayed tasks that are now due can be locked again
+                now = time.time()
+                while scheduled and scheduled[0][0] <= now:
+                    due, lock_type = heapq.heappop(scheduled)
+                    if lock_type:
+                        accounting.ready(lock_type)
+                    else:
+                        # the task kept its lock and only needs a worker
+                        claimable = True
             except Exception as e:
                 logging.error("uncaught exception: {}".format(e))
                 time.sleep(1)
@@ -201,6 +308,11 @@ try:
 except KeyboardInterrupt:
     pass
 
+if retention is not None:
+    logging.debug("shutting down retention")
+    retention.shutdown()
+    retention.join()
+
 logging.info("shutting down workers")
 for worker in workers:
     logging.debug("shutting down worker {}".format(worker.pid))
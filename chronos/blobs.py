@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from chronos.config import config
+
+# content addressed store for task files, task directories hard link to the blobs they use
+# so a blob's link count minus one is the number of task files referencing it
+blobs_dir = "blobs"
+
+# files smaller than this are written straight into the task directory
+min_size = config.getint("chronos", "blob_min_size", fallback=4096)
+
+# unreferenced blobs younger than this are kept so a blob being stored is not collected before it is linked
+gc_grace = config.getint("chronos", "blob_gc_grace", fallback=3600)
+
+def blob_path(digest):
+    return os.path.join(blobs_dir, digest[0:2], digest)
+
+# returns the number of task files that reference the blob
+def refs(digest):
+    try:
+        return os.stat(blob_path(digest)).st_nlink - 1
+    except FileNotFoundError:
+        return 0
+
+# moves the file at path into the store and returns its digest, the file is dropped if the blob already exists
+def store_file(path, digest=None):
+    if digest is None:
+        hasher = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+
+    target = blob_path(digest)
+    if os.path.isfile(target):
+        os.remove(path)
+        # refresh the mtime so gc leaves it alone until it is linked
+        os.utime(target)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+    return digest
+
+# stores content and returns its digest, nothing is written if the blob already exists
+def store_bytes(content):
+    digest = hashlib.sha256(content).hexdigest()
+    target = blob_path(digest)
+    if os.path.isfile(target):
+        os.utime(target)
+        return digest
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".blob-", dir=os.path.dirname(target))
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(content)
+        os.replace(temp_path, target)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return digest
+
+# makes dest a reference to the blob, replacing whatever file dest was
+def link(digest, dest):
+    temp_path = "{}.{}.link".format(dest, os.getpid())
+    os.link(blob_path(digest), temp_path)
+    try:
+        os.replace(temp_path, dest)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# deletes blobs no task file references anymore and returns the number deleted
+def gc():
+    deleted = 0
+    now = time.time()
+    for root, dirs, files in os.walk(blobs_dir):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                st = os.stat(path)
+                if st.st_nlink == 1 and now - st.st_mtime > gc_grace:
+                    os.remove(path)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+    if deleted > 0:
+        logging.info("deleted {} unreferenced blobs".format(deleted))
+    return deleted
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from chronos.cbapi import CbApi
+from chronos.config import config
+from chronos.runner import run_blocking
+
+# how long resolved and unknown hostnames are remembered and how many are kept
+sensor_cache_ttl = config.getint("carbon_black", "sensor_cache_ttl", fallback=300)
+sensor_cache_negative_ttl = config.getint("carbon_black", "sensor_cache_negative_ttl", fallback=60)
+sensor_cache_size = config.getint("carbon_black", "sensor_cache_size", fallback=10000)
+
+# seconds between listing live response sessions and between keep alives sent for a session
+session_list_interval = config.getint("carbon_black", "session_list_interval", fallback=10)
+session_keep_alive_interval = config.getint("carbon_black", "session_keep_alive_interval", fallback=60)
+
+# seconds between fetching the command list of a session
+command_poll_interval = config.getint("carbon_black", "command_poll_interval", fallback=10)
+
+# the only command status worth waiting on, any other status is final for the plugins
+COMMAND_PENDING = 'pending'
+
+# one client per process, shared by every carbon black plugin
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client, _client_pid
+    with _client_lock:
+        # never reuse a client (and its connections) inherited from the parent process
+        if _client is None or _client_pid != os.getpid():
+            url = config.get('carbon_black', 'url')
+            token = config.get('carbon_black', 'token')
+            _client = CbApi(url, ssl_verify=False, token=token)
+            _client_pid = os.getpid()
+        return _client
+
+class SensorCache(object):
+    # bounded hostname -> sensor id cache, unknown hostnames are cached as None for a shorter time
+    def __init__(self, ttl, negative_ttl, size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # returns (hit, sensor_id)
+    def get(self, hostname):
+        with self.lock:
+            entry = self.entries.get(hostname)
+            if entry is None:
+                return False, None
+            sensor_id, expires = entry
+            if time.time() >= expires:
+                del self.entries[hostname]
+                return False, None
+            self.entries.move_to_end(hostname)
+            return True, sensor_id
+
+    def put(self, hostname, sensor_id):
+        ttl = self.ttl if sensor_id is not None else self.negative_ttl
+        with self.lock:
+            self.entries[hostname] = (sensor_id, time.time() + ttl)
+            self.entries.move_to_end(hostname)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def resolve(self, cb, hostname):
+        key = hostname.lower()
+        hit, sensor_id = self.get(key)
+        if hit:
+            return sensor_id
+
+        logging.debug("looking up sensor for {}".format(hostname))
+        sensors = cb.sensors({"hostname":hostname})
+        sensor_id = sensors[0]['id'] if len(sensors) > 0 else None
+        self.put(key, sensor_id)
+        return sensor_id
+
+sensor_cache = SensorCache(sensor_cache_ttl, sensor_cache_negative_ttl, sensor_cache_size)
+
+# returns the sensor id for hostname or None if carbon black does not know it
+def resolve_sensor(hostname):
+    return sensor_cache.resolve(get_client(), hostname)
+
+class SessionPool(object):
+    # tracks the active and pending live response session of each sensor so every task against a host shares one
+    # sessions are listed at most once every list_interval instead of on every pass of every task
+    # carbon black is never called while holding the lock, only one thread lists sessions and only one thread per
+    # sensor creates a session, everyone else keeps using what is known
+    def __init__(self, list_interval, keep_alive_interval):
+        self.list_interval = list_interval
+        self.keep_alive_interval = keep_alive_interval
+        self.sessions = {}
+        self.kept_alive = {}
+        self.listed = 0
+        self.listing = False
+        # sensor id -> time a session was created for it and lock held while creating one
+        self.created = {}
+        self.creating = {}
+        self.lock = threading.Lock()
+
+    def refresh(self, cb, force=False):
+        with self.lock:
+            if self.listing or (not force and time.time() - self.listed < self.list_interval):
+                return
+            self.listing = True
+        try:
+            started = time.time()
+            sessions = {}
+            for sess in cb.live_response_session_list():
+                if sess['status'] not in ('active', 'pending'):
+                    continue
+                # prefer an active session if a sensor has more than one
+                current = sessions.get(sess['sensor_id'])
+                if current is None or current['status'] != 'active':
+                    sessions[sess['sensor_id']] = sess
+        finally:
+            with self.lock:
+                self.listing = False
+
+        with self.lock:
+            # sessions created while listing may be missing from the list
+            for sensor_id, created in self.created.items():
+                if created >= started and sensor_id not in sessions and sensor_id in self.sessions:
+                    sessions[sensor_id] = self.sessions[sensor_id]
+            self.sessions = sessions
+            self.created = { sensor_id: t for sensor_id, t in self.created.items() if t >= started }
+            ids = set(sess['id'] for sess in sessions.values())
+            self.kept_alive = { id: t for id, t in self.kept_alive.items() if id in ids }
+            self.listed = time.time()
+
+    def keep_alive(self, cb, session):
+        with self.lock:
+            if time.time() - self.kept_alive.get(session['id'], 0) < self.keep_alive_interval:
+                return
+            self.kept_alive[session['id']] = time.time()
+        try:
+            cb.live_response_session_keep_alive(session['id'])
+        except Exception as e:
+            logging.warning("unable to keep session {} alive: {}".format(session['id'], e))
+
+    # returns the session for sensor_id, creating one if the sensor has none
+    def get(self, cb, sensor_id):
+        self.refresh(cb)
+        with self.lock:
+            session = self.sessions.get(sensor_id)
+            if session is None:
+                creating = self.creating.setdefault(sensor_id, threading.Lock())
+
+        # tasks against the same sensor wait for the one creating its session, other sensors are not held up
+        if session is None:
+            with creating:
+                with self.lock:
+                    session = self.sessions.get(sensor_id)
+                if session is None:
+                    logging.debug("no existing sessions found. creating new session")
+                    try:
+                        session = cb.live_response_session_create(sensor_id)
+                        with self.lock:
+                            self.sessions[sensor_id] = session
+                            self.created[sensor_id] = time.time()
+                    finally:
+                        with self.lock:
+                            if self.creating.get(sensor_id) is creating:
+                                del self.creating[sensor_id]
+
+        if session['status'] == 'active':
+            self.keep_alive(cb, session)
+        return session
+
+    # forgets the session of sensor_id, used when a session turns out to be closed
+    def discard(self, sensor_id):
+        with self.lock:
+            self.sessions.pop(sensor_id, None)
+
+session_pool = SessionPool(session_list_interval, session_keep_alive_interval)
+
+# returns the shared live response session for sensor_id
+def get_session(sensor_id):
+    return session_pool.get(get_client(), sensor_id)
+
+def discard_session(sensor_id):
+    session_pool.discard(sensor_id)
+
+# waits for the shared session of sensor_id to become active, returns None if it closed instead
+async def wait_for_session(sensor_id):
+    while True:
+        session = await run_blocking(get_session, sensor_id)
+        logging.debug("session {} status is {}".format(session['id'], session['status']))
+        if session['status'] == 'active':
+            return session
+        if session['status'] != 'pending':
+            discard_session(sensor_id)
+            return None
+        await asyncio.sleep(session_list_interval)
+
+class CommandPoller(object):
+    # fetches the command list of a session once per interval and fans the statuses out to every task using it
+    # async tasks wait on a future that is only resolved when their command changes status
+    def __init__(self, interval):
+        self.interval = interval
+        self.lists = {}
+        self.lock = threading.Lock()
+
+        # only touched from the worker's event loop
+        self.waiters = {}
+        self.pollers = {}
+
+    # returns the command list of session_id, fetching it if the cached one is older than interval
+    def commands(self, cb, session_id, force=False):
+        with self.lock:
+            entry = self.lists.get(session_id)
+            if not force and entry is not None and time.time() - entry[0] < self.interval:
+                return entry[1]
+        commands = cb.live_response_session_command_list(session_id)
+        with self.lock:
+            self.lists[session_id] = (time.time(), commands)
+        return commands
+
+    def find(self, cb, session_id, name, object):
+        for cmd in self.commands(cb, session_id):
+            if cmd['name'] == name and cmd['object'] == object:
+                return cmd
+        return None
+
+    # returns the command once its status is different from the one it has now
+    async def wait(self, cb, session_id, command):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters.setdefault(session_id, []).append((command['id'], command['status'], future))
+        poller = self.pollers.get(session_id)
+        if poller is None or poller.done():
+            self.pollers[session_id] = loop.create_task(self.poll(cb, session_id))
+        return await future
+
+    async def poll(self, cb, session_id):
+        try:
+            while self.waiters.get(session_id):
+                await asyncio.sleep(self.interval)
+                try:
+                    commands = await run_blocking(self.commands, cb, session_id, True)
+                except Exception as e:
+                    for command_id, status, future in self.waiters.pop(session_id, []):
+                        if not future.done():
+                            future.set_exception(e)
+                    break
+
+                commands = { cmd['id']: cmd for cmd in commands }
+                waiting = []
+                for command_id, status, future in self.waiters.get(session_id, []):
+                    if future.done():
+                        continue
+                    cmd = commands.get(command_id)
+                    if cmd is None:
+                        future.set_exception(Exception("command {} no longer exists in session {}".format(command_id, session_id)))
+                    elif cmd['status'] != status:
+                        future.set_result(cmd)
+                    else:
+                        waiting.append((command_id, status, future))
+                self.waiters[session_id] = waiting
+        finally:
+            self.pollers.pop(session_id, None)
+            if not self.waiters.get(session_id):
+                self.waiters.pop(session_id, None)
+                with self.lock:
+                    self.lists.pop(session_id, None)
+
+command_poller = CommandPoller(command_poll_interval)
+
+# returns the command with name and object in session_id if it was already posted
+def find_command(session_id, name, object):
+    return command_poller.find(get_client(), session_id, name, object)
+
+# waits until command is no longer pending and returns it
+async def wait_for_command(session_id, command):
+    while command['status'] == COMMAND_PENDING:
+        logging.debug("waiting on command {} with status {}".format(command['id'], command['status']))
+        command = await command_poller.wait(get_client(), session_id, command)
+    return command
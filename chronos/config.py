@@ -8,10 +8,13 @@ from configparser import ConfigParser
 # required directories
 tasks_dir = os.path.join(CHRONOS_HOME, 'tasks')
 logs_dir = os.path.join(CHRONOS_HOME, 'logs')
+blobs_dir = os.path.join(CHRONOS_HOME, 'blobs')
 if not os.path.isdir(tasks_dir):
     os.mkdir(tasks_dir)
 if not os.path.isdir(logs_dir):
     os.mkdir(logs_dir)
+if not os.path.isdir(blobs_dir):
+    os.mkdir(blobs_dir)
 
 # initialize loggin
 try:
@@ -1,6 +1,11 @@
 import logging
+import os
+import threading
+import time
 
+from chronos import metrics
 from chronos.config import config
+from chronos.notify import notify
 from chronos.task import Task
 
 import pymysql
@@ -17,17 +22,250 @@ STATUS_QUEUED = 'queued'
 STATUS_RUNNING = 'running'
 STATUS_COMPLETE = 'complete'
 STATUS_ERROR = 'error'
+STATUS_TIMED_OUT = 'timed_out'
+
+# statuses a task never leaves
+STATUS_DONE = (STATUS_COMPLETE, STATUS_ERROR, STATUS_TIMED_OUT)
+
+# seconds a connection may sit unused before it is pinged ahead of the next query, 0 to never ping
+# a dead connection is otherwise detected by the query itself failing, which is retried once
+ping_idle = config.getint('mysql', 'ping_idle', fallback=0)
+
+# seconds between the daemon folding the changes appended by the tasks triggers into task_summary
+# the counts shown by the web service lag behind by up to this long
+summary_fold_interval = config.getint('chronos', 'summary_fold_interval', fallback=5)
+summary_fold_batch = config.getint('chronos', 'summary_fold_batch', fallback=10000)
+
+# seconds between the daemon checking task_summary against the tasks table
+summary_check_interval = config.getint('chronos', 'summary_check_interval', fallback=600)
+
+# client errors that mean the connection was lost and the query can be retried on a new one
+CONNECTION_ERRORS = (2006, 2013, 2014, 2045, 2055)
+
+# client errors raised before the query reached the server, the other connection errors can happen after the
+# server already ran it
+NOT_SENT_ERRORS = (2006,)
+
+# the queries run constantly by the daemon and web service, these must always use an index
+# HOT_QUERIES lists them with example arguments for check_plans in chronos/migrate.py
+SELECT_LOCKS = """
+    SELECT lock_type, sum(locked), sum(waiting)
+    FROM (
+        SELECT lock_type, locked, status = %s AS waiting
+        FROM tasks
+        WHERE status = %s OR status = %s
+        UNION ALL
+        SELECT lock_type, granted, NOT granted
+        FROM locks
+    ) AS held
+    GROUP BY lock_type
+"""
+
+SELECT_HELD = """
+    SELECT
+        (SELECT count(*) FROM tasks WHERE status IN (%s, %s) AND lock_type = %s AND locked = 1) +
+        (SELECT count(*) FROM locks WHERE lock_type = %s AND granted = 1)
+"""
+
+LOCK_OLDEST = """
+    UPDATE tasks
+    SET locked = 1, locked_at = now()
+    WHERE locked = 0 AND status = %s AND lock_type = %s AND modified <= now()
+    ORDER BY created
+    LIMIT %s
+"""
+
+CLAIM_TASKS = """
+    UPDATE tasks
+    SET claimed_by = %s, claim_expires = now() + INTERVAL %s SECOND
+    WHERE status = %s AND modified <= now() AND locked = 1
+        AND (claimed_by IS NULL OR claim_expires < now())
+    ORDER BY created
+    LIMIT %s
+"""
+
+READ_CLAIM = """
+    SELECT HEX(id), plugin, lock_type, locked_at
+    FROM tasks
+    WHERE claimed_by = %s AND status = %s
+    ORDER BY created
+"""
+
+RELEASE_TASKS = """
+    UPDATE tasks
+    SET claimed_by = NULL, claim_expires = NULL
+    WHERE claimed_by = %s AND status = %s
+"""
+
+GRANT_LEASES = """
+    UPDATE locks
+    SET granted = 1, granted_at = now(), kept_alive = now()
+    WHERE lock_type = %s AND granted = 0
+    ORDER BY created
+    LIMIT %s
+"""
+
+EXPIRE_LEASES = """
+    DELETE FROM locks
+    WHERE lock_type = %s AND granted = 1 AND kept_alive < now() - INTERVAL %s SECOND
+"""
+
+SELECT_EXPIRED_TASKS = """
+    SELECT HEX(id)
+    FROM tasks
+    WHERE status IN (%s, %s, %s) AND plugin = %s AND modified < now() - INTERVAL %s SECOND
+    ORDER BY modified
+    LIMIT %s
+"""
+
+HOT_QUERIES = [
+    ("select_locks", SELECT_LOCKS, (STATUS_QUEUED, STATUS_QUEUED, STATUS_RUNNING)),
+    ("select_held", SELECT_HELD, (STATUS_QUEUED, STATUS_RUNNING, 'default', 'default')),
+    ("lock_oldest", LOCK_OLDEST, (STATUS_QUEUED, 'default', 1)),
+    ("claim_tasks", CLAIM_TASKS, ('explain', 60, STATUS_QUEUED, 1)),
+    ("read_claim", READ_CLAIM, ('explain', STATUS_QUEUED)),
+    ("release_tasks", RELEASE_TASKS, ('explain', STATUS_QUEUED)),
+    ("grant_leases", GRANT_LEASES, ('default', 1)),
+    ("expire_leases", EXPIRE_LEASES, ('default', 5)),
+    ("select_expired_tasks", SELECT_EXPIRED_TASKS, STATUS_DONE + ('explain', 60, 1)),
+]
+
+# check_summary counts every task on purpose, it runs every summary_check_interval seconds and is left out of
+# HOT_QUERIES, select_statistics only reads the few rows of task_summary
+
+def open_connection():
+    # every statement commits on its own, so no query needs a separate COMMIT round trip
+    return pymysql.connect(host=host, db=db, user=user, passwd=passwd, unix_socket=unix_socket, charset='utf8', autocommit=True)
+
+def is_connection_error(e):
+    if isinstance(e, pymysql.err.InterfaceError):
+        return True
+    return isinstance(e, pymysql.err.OperationalError) and len(e.args) > 0 and e.args[0] in CONNECTION_ERRORS
+
+# True if the query failed without ever reaching the server
+def is_not_sent_error(e):
+    if isinstance(e, pymysql.err.InterfaceError):
+        return True
+    return isinstance(e, pymysql.err.OperationalError) and len(e.args) > 0 and e.args[0] in NOT_SENT_ERRORS
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool(object):
+    # bounded per process pool of connections, a Database checks one out when created and returns it on exit
+    def __init__(self, size, timeout=10, check_idle=1):
+        # most connections open at once, seconds to wait for one and seconds idle before checking health on checkout
+        self.size = size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.health_check_failures = 0
+
+    def get(self):
+        conn = None
+        with self.condition:
+            # connections inherited from a parent process must never be used
+            if self.pid != os.getpid():
+                self.reset()
+
+            deadline = time.time() + self.timeout
+            while True:
+                if self.idle:
+                    conn, returned = self.idle.pop()
+                    break
+                if self.open < self.size:
+                    self.open += 1
+                    returned = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout("no database connection available after {} seconds".format(self.timeout))
+                self.waits += 1
+                self.condition.wait(remaining)
+            self.in_use += 1
+            self.checkouts += 1
+
+        try:
+            # make sure a connection that sat idle is still alive before handing it out
+            if conn is not None and time.time() - returned >= self.check_idle:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception as e:
+                    logging.warning("discarding dead pooled connection: {}".format(e))
+                    with self.condition:
+                        self.health_check_failures += 1
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                    conn = None
+            if conn is None:
+                conn = open_connection()
+        except:
+            with self.condition:
+                self.open -= 1
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        return conn
+
+    def put(self, conn, broken=False):
+        with self.condition:
+            if self.pid != os.getpid():
+                return
+            self.in_use -= 1
+            if broken:
+                self.open -= 1
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            else:
+                self.idle.append((conn, time.time()))
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "open": self.open,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "health_check_failures": self.health_check_failures,
+            }
 
 class Database:
     _conn = None
 
     @property
     def connection(self):
-        if not self.is_connected():
+        if self._conn is None:
+            # a pooled connection is only checked out by connect, waiting on the pool again here would double the wait
+            if self.pool is not None:
+                raise pymysql.err.InterfaceError("no database connection")
             self.connect()
         return self._conn
 
-    def __init__(self):
+    def __init__(self, pool=None):
+        self.pool = pool
+        # number of requests sent to the server by this Database, queries and pings alike
+        self.round_trips = 0
+        self.last_used = time.time()
+        self.in_transaction = False
         self.connect()
 
     def __enter__(self):
@@ -36,203 +274,540 @@ class Database:
     def __exit__(self, exc_type, exc_value, traceback):
         self.disconnect()
 
-    def is_connected(self):
-        connected = False
+    def reconnect(self):
+        self.disconnect(broken=True)
+        self.connect()
+
+    # executes a query and returns the cursor, a query that fails because the connection was lost is retried once
+    # a query that must not run twice, such as one that hands out locks, is only retried if it was never sent
+    # nothing is retried inside a transaction, a new connection would run the query outside of it
+    def execute(self, query, args=None, idempotent=True):
+        if ping_idle > 0 and time.time() - self.last_used > ping_idle and self._conn is not None and not self.in_transaction:
+            self.round_trips += 1
+            try:
+                self._conn.ping(reconnect=False)
+            except Exception as e:
+                logging.warning("database connection went away while idle: {}".format(e))
+                self.reconnect()
+
+        for attempt in range(2):
+            try:
+                c = self.connection.cursor()
+                self.round_trips += 1
+                start = time.time()
+                c.execute(query, args)
+                self.last_used = time.time()
+                metrics.observe("chronos_db_query_seconds", self.last_used - start, buckets=metrics.QUERY_BUCKETS)
+                return c
+            except Exception as e:
+                if attempt > 0 or not is_connection_error(e):
+                    raise
+                if self.in_transaction or (not idempotent and not is_not_sent_error(e)):
+                    self.reconnect()
+                    raise
+                logging.warning("lost database connection, reconnecting: {}".format(e))
+                self.reconnect()
+
+    # a PoolTimeout is raised to the caller, every connection of the pool is busy so there is no point in going on
+    # starts a transaction on the connection, end it with commit or rollback
+    def begin(self, isolation=None, snapshot=False):
+        if isolation is not None:
+            self.execute("SET TRANSACTION ISOLATION LEVEL {}".format(isolation))
+        self.execute("START TRANSACTION WITH CONSISTENT SNAPSHOT" if snapshot else "START TRANSACTION")
+        self.in_transaction = True
+
+    def commit(self):
         try:
-            c = self._conn.cursor()
-            c.execute("DO 1")
-            connected = True
-        except:
-            pass
-        return connected
+            self.execute("COMMIT")
+        finally:
+            self.in_transaction = False
+
+    # rolls back the transaction, or drops the connection if that fails so the server rolls it back
+    def rollback(self):
+        try:
+            self.execute("ROLLBACK")
+        except Exception:
+            self.reconnect()
+        finally:
+            self.in_transaction = False
 
     def connect(self):
         try:
             self.disconnect()
-            #self._conn = MySQLdb.connect(host=host, db=db, user=user, passwd=passwd, charset='utf8')
-            self._conn = pymysql.connect(host=host, db=db, user=user, passwd=passwd, unix_socket=unix_socket, charset='utf8')
-            
+            if self.pool is not None:
+                self._conn = self.pool.get()
+            else:
+                self._conn = open_connection()
+        except PoolTimeout:
+            raise
         except Exception as e:
             logging.error("failed to connect to database: {}".format(str(e)))
 
-    def disconnect(self):
+    # closes the connection, or returns it to the pool unless it is broken
+    def disconnect(self, broken=False):
         if self._conn is not None:
-            self._conn.close()
+            if self.pool is not None:
+                self.pool.put(self._conn, broken)
+            else:
+                self._conn.close()
+            self._conn = None
 
+    # returns (lock_type, held locks, waiting) counting both tasks and leases
+    # waiting is the number of queued tasks and leases not granted yet
     def select_locks(self):
         locks = []
         try:
-            c = self.connection.cursor()
-            c.execute("""
-                SELECT lock_type, sum(locked)
-                FROM tasks
-                WHERE status = %s OR status = %s
-                GROUP BY lock_type
-            """, (STATUS_QUEUED, STATUS_RUNNING))
+            c = self.execute(SELECT_LOCKS, (STATUS_QUEUED, STATUS_QUEUED, STATUS_RUNNING))
             locks = c.fetchall()
-            self.connection.commit()
         except Exception as e:
             logging.error("failed to select locks: {}".format(str(e)))
         return locks
 
+    # takes the named lock that lets one lock manager at a time hand out locks of lock_type
+    # returns False without waiting if another lock manager sharing the database holds it
+    def acquire_lock_type(self, lock_type):
+        try:
+            c = self.execute("SELECT GET_LOCK(%s, 0)", ("chronos_lock_{}".format(lock_type),))
+            return c.fetchone()[0] == 1
+        except Exception as e:
+            logging.error("failed to acquire lock manager lock for {}: {}".format(lock_type, str(e)))
+        return False
+
+    def release_lock_type(self, lock_type):
+        try:
+            self.execute("SELECT RELEASE_LOCK(%s)", ("chronos_lock_{}".format(lock_type),))
+        except Exception as e:
+            logging.error("failed to release lock manager lock for {}: {}".format(lock_type, str(e)))
+
+    # returns the number of locks of lock_type held by tasks and leases, or None if it could not be counted
+    def select_held(self, lock_type):
+        try:
+            c = self.execute(SELECT_HELD, (STATUS_QUEUED, STATUS_RUNNING, lock_type, lock_type))
+            return int(c.fetchone()[0])
+        except Exception as e:
+            logging.error("failed to count held locks of {}: {}".format(lock_type, str(e)))
+        return None
+
     def lock_oldest(self, lock_type, count):
+        locked = 0
         try:
-            c = self.connection.cursor()
-            c.execute("""
-                UPDATE tasks
-                SET locked = 1, locked_at = now()
-                WHERE locked = 0 AND status = %s AND lock_type = %s AND modified <= now()
-                ORDER BY created
-                LIMIT %s
-                """, (STATUS_QUEUED, lock_type, int(count)))
-            self.connection.commit()
+            c = self.execute(LOCK_OLDEST, (STATUS_QUEUED, lock_type, int(count)), idempotent=False)
+            locked = c.rowcount
         except Exception as e:
             logging.error("failed to get lock {} for {} tasks: {}".format(lock_type, count, str(e)))
+        return locked
 
-    def get_next_task(self):
-        row = None
+    def claim_tasks(self, claim_id, count, lease):
+        # atomically mark up to count of the oldest available tasks as ours, then read them back
+        # the claim is a lease, tasks that are not started before it expires can be claimed by anyone
+        rows = []
         try:
-            c = self.connection.cursor()
-            c.execute("""
-                SELECT HEX(id), plugin, lock_type, locked_at
-                FROM tasks
-                WHERE status = %s AND modified <= now() AND locked = 1
-                ORDER BY created
-                LIMIT 1
-            """, (STATUS_QUEUED))
-            row = c.fetchone()
-            self.connection.commit()
+            c = self.execute(CLAIM_TASKS, (claim_id, int(lease), STATUS_QUEUED, int(count)), idempotent=False)
+            claimed = c.rowcount
+            if claimed > 0:
+                c = self.execute(READ_CLAIM, (claim_id, STATUS_QUEUED))
+                rows = c.fetchall()
         except Exception as e:
-            logging.error("failed to get next task: {}".format(str(e)))
-        if row is None:
-            return None
-        task = Task(self, row[0], row[1], row[2], row[3])
-        self.start_task(task.id)
-        return task
+            logging.error("failed to claim tasks: {}".format(str(e)))
+        return [Task(self, row[0], row[1], row[2], row[3], claim_id) for row in rows]
+
+    def start_task(self, task):
+        # returns False if our claim on the task was lost
+        started = False
+        try:
+            c = self.execute("""
+                UPDATE tasks
+                SET status = %s
+                WHERE id = UNHEX(%s) AND claimed_by = %s AND status = %s
+                """, (STATUS_RUNNING, task.id, task.claim_id, STATUS_QUEUED))
+            started = c.rowcount > 0
+        except Exception as e:
+            logging.error("failed to start task {}: {}".format(task.id, str(e)))
+        if started:
+            logging.info("running task {}".format(task.id))
+        return started
+
+    def release_tasks(self, claim_id):
+        # give back tasks that were claimed but never started
+        try:
+            c = self.execute(RELEASE_TASKS, (claim_id, STATUS_QUEUED))
+            if c.rowcount > 0:
+                notify("release")
+        except Exception as e:
+            logging.error("failed to release tasks claimed by {}: {}".format(claim_id, str(e)))
 
+    # returns True if the task was new
     def insert_task(self, id, plugin, lock_type):
+        return self.insert_tasks([(id, plugin, lock_type)]) > 0
+
+    # inserts a list of (id, plugin, lock_type) with one statement, tasks that already exist are ignored
+    # returns the number of tasks that were new
+    def insert_tasks(self, tasks):
+        inserted = 0
+        if not tasks:
+            return inserted
         try:
-            c = self.connection.cursor()
-            c.execute("""
+            values = []
+            for id, plugin, lock_type in tasks:
+                values.extend((id, plugin, lock_type, STATUS_QUEUED))
+            c = self.execute("""
                 INSERT IGNORE INTO tasks (id, plugin, lock_type, status, created)
-                VALUES (UNHEX(%s), %s, %s, %s, now())
-                """, (id, plugin, lock_type, STATUS_QUEUED))
-            self.connection.commit()
+                VALUES {}
+                """.format(", ".join(["(UNHEX(%s), %s, %s, %s, now())"] * len(tasks))), values)
+            inserted = c.rowcount
+            for lock_type in set(task[2] for task in tasks):
+                notify("insert", lock_type=lock_type)
         except Exception as e:
-            logging.error("failed to insert task {}: {}".format(id, str(e)))
+            logging.error("failed to insert {} tasks: {}".format(len(tasks), str(e)))
+        return inserted
 
+    # archived tasks keep answering status requests
     def select_status(self, id):
         row = None
         try:
-            c = self.connection.cursor()
-            c.execute("""
-                SELECT status
-                FROM tasks
-                WHERE id = UNHEX(%s)
-                """, (id))
+            c = self.execute("""
+                SELECT status FROM tasks WHERE id = UNHEX(%s)
+                UNION ALL
+                SELECT status FROM tasks_archive WHERE id = UNHEX(%s)
+                LIMIT 1
+                """, (id, id))
             row = c.fetchone()
-            self.connection.commit()
         except Exception as e:
             logging.error("failed to select status of task {}: {}".format(id, str(e)))
         if row is None:
             return None
         return row[0]
 
+    # returns a dict of id -> status for every id that exists, looked up with one query
+    def select_statuses(self, ids):
+        statuses = {}
+        if not ids:
+            return statuses
+        try:
+            placeholders = ", ".join(["UNHEX(%s)"] * len(ids))
+            c = self.execute("""
+                SELECT HEX(id), status, 0 FROM tasks WHERE id IN ({})
+                UNION ALL
+                SELECT HEX(id), status, 1 FROM tasks_archive WHERE id IN ({})
+                """.format(placeholders, placeholders), list(ids) + list(ids))
+            # a task created again after it was archived reports its current status
+            for id, status, archived in c.fetchall():
+                if not archived or id not in statuses:
+                    statuses[id] = status
+        except Exception as e:
+            logging.error("failed to select status of {} tasks: {}".format(len(ids), str(e)))
+        return statuses
+
+    # returns 1 if the lease or task with id holds a lock, 0 if it does not and None if there is no such lock
     def select_lock_status(self, id):
         row = None
         try:
-            c = self.connection.cursor()
-            c.execute("""
-                SELECT locked
-                FROM tasks
-                WHERE id = UNHEX(%s)
-                """, (id))
+            c = self.execute("""
+                SELECT granted FROM locks WHERE id = UNHEX(%s)
+                UNION ALL
+                SELECT locked FROM tasks WHERE id = UNHEX(%s)
+                LIMIT 1
+                """, (id, id))
             row = c.fetchone()
-            self.connection.commit()
         except Exception as e:
-            logging.error("failed to select lock status of task {}: {}".format(id, str(e)))
+            logging.error("failed to select lock status of {}: {}".format(id, str(e)))
         if row is None:
             return None
         return row[0]
 
+    # returns a dict of id -> lock status for every lease or task that exists, looked up with one query
+    def select_lock_statuses(self, ids):
+        statuses = {}
+        if not ids:
+            return statuses
+        try:
+            placeholders = ", ".join(["UNHEX(%s)"] * len(ids))
+            c = self.execute("""
+                SELECT HEX(id), granted, 0 FROM locks WHERE id IN ({})
+                UNION ALL
+                SELECT HEX(id), locked, 1 FROM tasks WHERE id IN ({})
+                """.format(placeholders, placeholders), list(ids) + list(ids))
+            # a lease wins over a task with the same id, as in select_lock_status
+            for id, status, is_task in c.fetchall():
+                if not is_task or id not in statuses:
+                    statuses[id] = status
+        except Exception as e:
+            logging.error("failed to select lock status of {} locks: {}".format(len(ids), str(e)))
+        return statuses
+
     def lock_keep_alive(self, id):
         try:
-            c = self.connection.cursor()
-            c.execute("""
-                UPDATE tasks
-                SET locked_at = now()
+            c = self.execute("""
+                UPDATE locks
+                SET kept_alive = now()
                 WHERE id = UNHEX(%s)
                 """, (id))
-            self.connection.commit()
+
+            # locks acquired before leases existed are tasks
+            if c.rowcount == 0:
+                self.execute("""
+                    UPDATE tasks
+                    SET locked_at = now()
+                    WHERE id = UNHEX(%s)
+                    """, (id))
         except Exception as e:
             logging.error("failed to keep lock alive {}: {}".format(id, str(e)))
 
-    def update_status(self, id, status, unlock=False):
+    def insert_lease(self, id, lock_type):
+        try:
+            self.execute("""
+                INSERT IGNORE INTO locks (id, lock_type, created)
+                VALUES (UNHEX(%s), %s, now())
+                """, (id, lock_type))
+            notify("insert", lock_type=lock_type)
+        except Exception as e:
+            logging.error("failed to insert lease {}: {}".format(id, str(e)))
+
+    # deletes the lease with id, returns False if there is no such lease
+    def release_lease(self, id):
+        row = None
+        try:
+            c = self.execute("""
+                SELECT lock_type, granted
+                FROM locks
+                WHERE id = UNHEX(%s)
+                """, (id))
+            row = c.fetchone()
+            if row is not None:
+                c = self.execute("""
+                    DELETE FROM locks
+                    WHERE id = UNHEX(%s)
+                    """, (id))
+                if c.rowcount > 0 and row[1]:
+                    notify("unlock", lock_type=row[0])
+        except Exception as e:
+            logging.error("failed to release lease {}: {}".format(id, str(e)))
+        return row is not None
+
+    # grants up to count of the oldest waiting leases of lock_type and returns the number granted
+    def grant_leases(self, lock_type, count):
+        granted = 0
+        try:
+            c = self.execute(GRANT_LEASES, (lock_type, int(count)), idempotent=False)
+            granted = c.rowcount
+        except Exception as e:
+            logging.error("failed to grant {} leases of {}: {}".format(count, lock_type, str(e)))
+        return granted
+
+    # deletes granted leases of lock_type not kept alive for timeout seconds and returns the number deleted
+    def expire_leases(self, lock_type, timeout):
+        expired = 0
+        try:
+            c = self.execute(EXPIRE_LEASES, (lock_type, int(timeout)))
+            expired = c.rowcount
+        except Exception as e:
+            logging.error("failed to expire leases of {}: {}".format(lock_type, str(e)))
+        if expired > 0:
+            logging.info("expired {} leases of {}".format(expired, lock_type))
+        return expired
+
+    def update_status(self, id, status, unlock=False, lock_type=None):
         lock_status =  0 if unlock else 1
         try:
-            c = self.connection.cursor()
-            c.execute("""
+            self.execute("""
                 UPDATE tasks
-                SET status = %s, locked = %s
+                SET status = %s, locked = %s, claimed_by = NULL, claim_expires = NULL
                 WHERE id = UNHEX(%s)
                 """, (status, lock_status, id))
-            self.connection.commit()
+            if unlock:
+                notify("unlock", lock_type=lock_type)
         except Exception as e:
             logging.error("failed to update status of task {}: {}".format(id, str(e)))
 
-    def start_task(self, id):
-        logging.info("running task {}".format(id))
-        self.update_status(id, STATUS_RUNNING)
-        return STATUS_RUNNING
-
-    def delay_task(self, id, seconds, unlock=False):
+    def delay_task(self, id, seconds, unlock=False, lock_type=None):
         logging.info("delaying task {} for {} seconds".format(id, seconds))
         lock_status =  0 if unlock else 1
         try:
-            c= self.connection.cursor()
-            c.execute("""
+            self.execute("""
                 UPDATE tasks
-                SET status = %s, modified = now() + INTERVAL %s SECOND, locked = %s
+                SET status = %s, modified = now() + INTERVAL %s SECOND, locked = %s, claimed_by = NULL, claim_expires = NULL
                 WHERE id = UNHEX(%s)
                 """, (STATUS_QUEUED, seconds, lock_status, id))
-            self.connection.commit()
+            notify("delay", seconds=seconds, unlock=unlock, lock_type=lock_type)
         except Exception as e:
             logging.error("failed to delay task {}: {}".format(id, str(e)))
         return STATUS_QUEUED
 
-    def fail_task(self, id, error):
+    def fail_task(self, id, error, lock_type=None):
         logging.error("task {} failed: {}".format(id, error))
-        self.update_status(id, STATUS_ERROR, True)
+        self.update_status(id, STATUS_ERROR, True, lock_type)
         return STATUS_ERROR
 
-    def complete_task(self, id):
+    def complete_task(self, id, lock_type=None):
         logging.info("task {} complete".format(id))
-        self.update_status(id, STATUS_COMPLETE, True)
+        self.update_status(id, STATUS_COMPLETE, True, lock_type)
         return STATUS_COMPLETE
 
+    # returns (status, number of tasks) read from the summary kept by the tasks triggers and the daemon
     def select_statistics(self):
         stats = []
         try:
-            c = self.connection.cursor()
-            c.execute("""
-                SELECT status, count(*)
-                FROM tasks
+            c = self.execute("""
+                SELECT status, sum(`count`)
+                FROM task_summary
                 GROUP BY status
+                HAVING sum(`count`) > 0
             """)
             stats = c.fetchall()
-            self.connection.commit()
         except Exception as e:
             logging.error("failed to select statistics: {}".format(str(e)))
         return stats
 
-    def queue_running_tasks(self):
+    # adds up to count of the deltas appended by the tasks triggers to task_summary and deletes them
+    # returns the number of deltas folded
+    def fold_summary(self, count):
+        folded = 0
+        try:
+            # read committed takes no gap locks, so the triggers keep appending while the deltas are folded
+            # locking the deltas read makes a second daemon folding at the same time wait instead of counting them twice
+            self.begin("READ COMMITTED")
+            c = self.execute("""
+                SELECT id, status, lock_type, delta
+                FROM task_summary_delta
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE
+                """, (int(count),))
+            rows = c.fetchall()
+            if rows:
+                totals = {}
+                for id, status, lock_type, delta in rows:
+                    totals[(status, lock_type)] = totals.get((status, lock_type), 0) + delta
+                for key, delta in sorted(totals.items()):
+                    if delta == 0:
+                        continue
+                    self.execute("""
+                        INSERT INTO task_summary (status, lock_type, `count`) VALUES (%s, %s, %s)
+                        ON DUPLICATE KEY UPDATE `count` = `count` + %s
+                        """, key + (delta, delta))
+                # only the ids read are deleted, a delta with a lower id may still be uncommitted and a range delete
+                # could remove it before it was ever folded
+                self.execute("""
+                    DELETE FROM task_summary_delta
+                    WHERE id IN ({})
+                    """.format(", ".join(["%s"] * len(rows))), [row[0] for row in rows])
+            self.commit()
+            folded = len(rows)
+        except Exception as e:
+            logging.error("failed to fold task summary deltas: {}".format(str(e)))
+            if self.in_transaction:
+                self.rollback()
+        return folded
+
+    # counts tasks per status and lock type and corrects task_summary wherever it drifted
+    # returns the number of summary rows corrected
+    def check_summary(self):
+        corrected = 0
+        try:
+            # the tasks, the summary and the deltas not folded yet are read from one snapshot without locking
+            # the difference found is the drift at that moment, it is appended as a delta like any other change
+            self.begin("REPEATABLE READ", snapshot=True)
+            c = self.execute("""
+                SELECT status, COALESCE(lock_type, ''), count(*)
+                FROM tasks
+                GROUP BY status, lock_type
+                """)
+            counts = {}
+            for status, lock_type, count in c.fetchall():
+                counts[(status, lock_type)] = counts.get((status, lock_type), 0) + count
+            c = self.execute("""
+                SELECT status, lock_type, sum(`count`)
+                FROM (
+                    SELECT status, lock_type, `count` FROM task_summary
+                    UNION ALL
+                    SELECT status, lock_type, delta FROM task_summary_delta
+                ) AS summary
+                GROUP BY status, lock_type
+                """)
+            summary = { (status, lock_type): int(count) for status, lock_type, count in c.fetchall() }
+            self.commit()
+
+            drifts = []
+            for key in sorted(set(counts) | set(summary)):
+                drift = counts.get(key, 0) - summary.get(key, 0)
+                if drift != 0:
+                    drifts.extend(key + (drift,))
+            if drifts:
+                corrected = len(drifts) // 3
+                self.execute("""
+                    INSERT INTO task_summary_delta (status, lock_type, delta)
+                    VALUES {}
+                    """.format(", ".join(["(%s, %s, %s)"] * corrected)), drifts, idempotent=False)
+        except Exception as e:
+            logging.error("failed to check task summary: {}".format(str(e)))
+            if self.in_transaction:
+                self.rollback()
+        if corrected > 0:
+            logging.warning("corrected {} task summary counts".format(corrected))
+        return corrected
+
+    def queue_running_tasks(self, node):
+        # only requeue tasks claimed by this node so other daemons sharing the database are left alone
         try:
-            c = self.connection.cursor()
-            c.execute("""
+            self.execute("""
                 UPDATE tasks
-                SET status = %s
-                WHERE status = %s
-                """, (STATUS_QUEUED, STATUS_RUNNING))
-            self.connection.commit()
+                SET status = %s, claimed_by = NULL, claim_expires = NULL
+                WHERE status = %s AND (claimed_by IS NULL OR SUBSTRING_INDEX(claimed_by, ':', 1) = %s)
+                """, (STATUS_QUEUED, STATUS_RUNNING, node))
         except Exception as e:
             logging.error("failed to queue running tasks: {}".format(str(e)))
+
+    # hands back the tasks claimed by the worker with pid on node, for when the worker died while holding them
+    # the tasks keep their locks so the next worker to claim them can run them right away
+    # returns the number of tasks requeued
+    def queue_worker_tasks(self, node, pid):
+        requeued = 0
+        try:
+            c = self.execute("""
+                UPDATE tasks
+                SET status = %s, claimed_by = NULL, claim_expires = NULL
+                WHERE status IN (%s, %s) AND SUBSTRING_INDEX(claimed_by, ':', 2) = %s
+                """, (STATUS_QUEUED, STATUS_QUEUED, STATUS_RUNNING, "{}:{}".format(node, pid)))
+            requeued = c.rowcount
+        except Exception as e:
+            logging.error("failed to queue tasks of worker {}: {}".format(pid, str(e)))
+        return requeued
+
+    # returns the ids of up to count finished tasks of plugin last modified more than ttl seconds ago
+    def select_expired_tasks(self, plugin, ttl, count):
+        ids = []
+        try:
+            c = self.execute(SELECT_EXPIRED_TASKS, STATUS_DONE + (plugin, int(ttl), int(count)))
+            ids = [row[0] for row in c.fetchall()]
+        except Exception as e:
+            logging.error("failed to select expired {} tasks: {}".format(plugin, str(e)))
+        return ids
+
+    # moves the finished tasks with ids to the archive table and returns the number moved
+    # both statements run in one short transaction that only locks the rows of this batch
+    def archive_tasks(self, ids):
+        archived = 0
+        if not ids:
+            return archived
+        placeholders = ", ".join(["UNHEX(%s)"] * len(ids))
+        try:
+            # not retried on a lost connection, a retried delete could remove rows the lost insert never archived
+            self.begin()
+            self.execute("""
+                REPLACE INTO tasks_archive (id, plugin, lock_type, status, created, modified)
+                SELECT id, plugin, lock_type, status, created, modified
+                FROM tasks
+                WHERE id IN ({}) AND status IN (%s, %s, %s)
+                """.format(placeholders), list(ids) + list(STATUS_DONE))
+            c = self.execute("""
+                DELETE FROM tasks
+                WHERE id IN ({}) AND status IN (%s, %s, %s)
+                """.format(placeholders), list(ids) + list(STATUS_DONE))
+            deleted = c.rowcount
+            self.commit()
+            archived = deleted
+        except Exception as e:
+            logging.error("failed to archive {} tasks: {}".format(len(ids), str(e)))
+            if self.in_transaction:
+                self.rollback()
+        return archived
@@ -0,0 +1,38 @@
+import hashlib
+import json
+
+from chronos.config import config
+
+# digest used to derive task ids, every choice produces 16 bytes to fit tasks.id
+# changing it changes the id of every new task so requests made before the change are not deduplicated
+DIGESTS = {
+    "md5": lambda: hashlib.md5(),
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+    "blake2s": lambda: hashlib.blake2s(digest_size=16),
+}
+task_id_digest = config.get("chronos", "task_id_digest", fallback="md5")
+if task_id_digest not in DIGESTS:
+    raise ValueError("unknown task_id_digest {}, expected one of {}".format(task_id_digest, ", ".join(sorted(DIGESTS))))
+
+# canonical encoding, key order and whitespace do not change the id of a request
+_encoder = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+# size of the encoded pieces handed to the hasher at once
+_buffer_size = 64 * 1024
+
+# returns the task id for plugin and request_json
+# the request is encoded in pieces straight into the hasher instead of being serialized to one string first
+def task_id(plugin, request_json, digest=None):
+    hasher = DIGESTS[digest or task_id_digest]()
+    hasher.update(plugin.encode("utf-8", "surrogatepass"))
+    buffer = []
+    buffered = 0
+    for chunk in _encoder.iterencode(request_json):
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= _buffer_size:
+            hasher.update("".join(buffer).encode("utf-8", "surrogatepass"))
+            buffer = []
+            buffered = 0
+    hasher.update("".join(buffer).encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest().upper()
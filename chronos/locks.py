@@ -0,0 +1,82 @@
+import logging
+
+from chronos import metrics
+from chronos.config import config
+
+# seconds between recounting held locks from the database
+reconcile_interval = config.getint("chronos", "lock_reconcile_interval", fallback=60)
+
+# seconds between looking for leases that missed their keep alive
+lease_check_interval = config.getint("chronos", "lease_check_interval", fallback=5)
+
+class LockAccounting(object):
+    # keeps count of the locks held per lock type so the lock manager does not have to scan the tasks table
+    # the counts are kept up to date from task events and recounted from the database every reconcile_interval
+    # with several daemons on one database the counts only decide when a lock type is worth looking at, locks are
+    # handed out against the count in the database while holding a named lock for the lock type
+    def __init__(self):
+        # lock_type -> number of locks currently held
+        self.held = {}
+        # lock types that may have tasks or leases waiting for a lock
+        self.waiting = set()
+
+    def reconcile(self, db):
+        locks = db.select_locks()
+        previous = set(self.held)
+        self.held = { lock_type: int(held or 0) for lock_type, held, waiting in locks }
+        self.waiting = set(self.held)
+        logging.debug("reconciled locks: {}".format(self.held))
+
+        # lock types that no longer have any tasks are reported as empty instead of keeping their last value
+        depth = { lock_type: int(waiting or 0) for lock_type, held, waiting in locks }
+        for lock_type in previous | set(self.held):
+            labels = {"lock_type":lock_type}
+            metrics.set("chronos_queue_depth", labels, depth.get(lock_type, 0))
+            metrics.set("chronos_locks_held", labels, self.held.get(lock_type, 0))
+
+    # a task or lease of this lock type was created or a task became due
+    def ready(self, lock_type):
+        self.waiting.add(lock_type)
+
+    # a task or lease of this lock type gave up its lock
+    def unlock(self, lock_type):
+        self.held[lock_type] = max(self.held.get(lock_type, 0) - 1, 0)
+        self.waiting.add(lock_type)
+
+    # grants as many waiting leases and locks as many waiting tasks of this lock type as allowed
+    # leases go first since a client is blocked on each of them, returns the number of locks handed out
+    def lock(self, db, lock_type, max_locks):
+        if max_locks - self.held.get(lock_type, 0) <= 0:
+            return 0
+
+        # another daemon is handing out locks of this type right now, try again on the next pass
+        if not db.acquire_lock_type(lock_type):
+            return 0
+        try:
+            held = db.select_held(lock_type)
+            if held is None:
+                return 0
+            self.held[lock_type] = held
+            available = max_locks - held
+            if available <= 0:
+                return 0
+            locked = db.grant_leases(lock_type, available)
+            if locked < available:
+                locked += db.lock_oldest(lock_type, available - locked)
+            self.held[lock_type] = held + locked
+        finally:
+            db.release_lock_type(lock_type)
+
+        # there is nothing left to lock until another task of this type is created or becomes due
+        if locked < available:
+            self.waiting.discard(lock_type)
+        return locked
+
+    # deletes leases that missed their keep alive, their locks go to whoever is waiting next
+    def expire(self, db, timeouts):
+        for lock_type in [lock_type for lock_type, held in self.held.items() if held > 0]:
+            expired = db.expire_leases(lock_type, timeouts(lock_type))
+            if expired > 0:
+                metrics.inc("chronos_leases_expired_total", {"lock_type":lock_type}, expired)
+                self.held[lock_type] = max(self.held[lock_type] - expired, 0)
+                self.waiting.add(lock_type)
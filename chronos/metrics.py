@@ -0,0 +1,249 @@
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from chronos import CHRONOS_HOME
+from chronos.config import config
+
+# file backed shared memory holding every metric, mapped by the daemon, its workers and the web service alike
+metrics_path = config.get("chronos", "metrics_path", fallback=os.path.join(CHRONOS_HOME, "metrics.dat"))
+
+# the file is a fixed size open addressed table of (series key, value) slots
+# the series key is the full prometheus series name including labels, e.g. chronos_tasks_created_total{plugin="lock"}
+SLOT = struct.Struct("120sd")
+SLOTS = 4096
+
+# seconds a process buffers its own updates before writing them to the shared file under the file lock
+# keeps the lock off the path of every query, a metric can lag behind by this long
+flush_interval = config.getfloat("chronos", "metrics_flush_interval", fallback=1.0)
+
+class MetricStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.fd = None
+        self.map = None
+        self.lock = threading.Lock()
+        # updates of this process not written to the file yet, key -> amount added and key -> value set
+        self.added = {}
+        self.values = {}
+        self.buffer_pid = None
+        self.flushed = 0
+
+    def open(self):
+        # every process maps the file itself, a mapping inherited through fork would still work
+        # but the flock has to be taken on a file description of our own
+        if self.pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        size = SLOT.size * SLOTS
+        if os.fstat(fd).st_size < size:
+            # the daemon and the web service usually run as different users
+            os.fchmod(fd, 0o666)
+            os.ftruncate(fd, size)
+        self.fd = fd
+        self.map = mmap.mmap(fd, size)
+        self.pid = os.getpid()
+
+    # returns the slot index of key, claiming an empty slot for it if create is set
+    def find(self, key, create):
+        start = zlib.crc32(key) % SLOTS
+        for probe in range(SLOTS):
+            index = (start + probe) % SLOTS
+            slot_key, value = SLOT.unpack_from(self.map, index * SLOT.size)
+            slot_key = slot_key.rstrip(b"\0")
+            if slot_key == key:
+                return index
+            if not slot_key:
+                if not create:
+                    return None
+                SLOT.pack_into(self.map, index * SLOT.size, key, 0.0)
+                return index
+        return None
+
+    # applies function to the current value of every key in updates, all under one lock
+    def update(self, updates, function):
+        with self.lock:
+            self.open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                for key, value in updates:
+                    key = key.encode("utf-8")
+                    if len(key) > 120:
+                        logging.warning("metric key too long: {}".format(key))
+                        continue
+                    index = self.find(key, True)
+                    if index is None:
+                        logging.warning("metric store is full, dropping {}".format(key))
+                        continue
+                    offset = index * SLOT.size
+                    slot_key, current = SLOT.unpack_from(self.map, offset)
+                    SLOT.pack_into(self.map, offset, key, function(current, value))
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    # buffers updates in this process and writes them out at most every flush_interval seconds
+    def buffer(self, updates, pending):
+        with self.lock:
+            # a forked child starts without the updates its parent has not written yet
+            if self.buffer_pid != os.getpid():
+                self.added = {}
+                self.values = {}
+                self.buffer_pid = os.getpid()
+                self.flushed = time.time()
+            for key, value in updates:
+                if pending is self.ADD:
+                    self.added[key] = self.added.get(key, 0) + value
+                else:
+                    self.values[key] = value
+        if time.time() - self.flushed >= flush_interval:
+            self.flush()
+
+    ADD = "add"
+    SET = "set"
+
+    def add(self, updates):
+        self.buffer(updates, self.ADD)
+
+    def set(self, updates):
+        self.buffer(updates, self.SET)
+
+    # writes the buffered updates of this process to the shared file
+    def flush(self):
+        with self.lock:
+            if self.buffer_pid != os.getpid():
+                return
+            added, self.added = self.added, {}
+            values, self.values = self.values, {}
+            self.flushed = time.time()
+        if values:
+            self.update(values.items(), lambda current, value: value)
+        if added:
+            self.update(added.items(), lambda current, value: current + value)
+
+    # returns a dict of every key -> value
+    def items(self):
+        self.flush()
+        values = {}
+        with self.lock:
+            self.open()
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                for index in range(SLOTS):
+                    slot_key, value = SLOT.unpack_from(self.map, index * SLOT.size)
+                    slot_key = slot_key.rstrip(b"\0")
+                    if slot_key:
+                        values[slot_key.decode("utf-8")] = value
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return values
+
+store = MetricStore(metrics_path)
+
+# returns the series key for name and labels
+def series(name, labels=None):
+    if not labels:
+        return name
+    return "{}{{{}}}".format(name, ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())))
+
+# upper bounds of the default histogram buckets in seconds, long enough for a plugin holding its lock
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600)
+
+# buckets for database queries
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+# metrics are best effort, a problem with the store must never break the caller
+def inc(name, labels=None, value=1):
+    try:
+        store.add([(series(name, labels), value)])
+    except Exception as e:
+        logging.debug("unable to update metric {}: {}".format(name, e))
+
+# sets a gauge
+def set(name, labels=None, value=0):
+    try:
+        store.set([(series(name, labels), value)])
+    except Exception as e:
+        logging.debug("unable to update metric {}: {}".format(name, e))
+
+# records value in a prometheus style histogram of cumulative buckets plus _sum and _count
+def observe(name, value, labels=None, buckets=DEFAULT_BUCKETS):
+    try:
+        bucket_keys, inf_key, sum_key, count_key = histogram_keys(name, labels, buckets)
+        # every bucket is written, even with 0, so each series always has the full set of buckets
+        updates = [(key, 1 if value <= bound else 0) for bound, key in bucket_keys]
+        updates.append((inf_key, 1))
+        updates.append((sum_key, value))
+        updates.append((count_key, 1))
+        store.add(updates)
+    except Exception as e:
+        logging.debug("unable to update metric {}: {}".format(name, e))
+
+# series keys of each histogram, built once since they are needed on every observation
+_histogram_keys = {}
+
+def histogram_keys(name, labels, buckets):
+    labels = labels or {}
+    cache_key = (name, tuple(sorted(labels.items())), buckets)
+    keys = _histogram_keys.get(cache_key)
+    if keys is None:
+        keys = (
+            [(bound, series(name + "_bucket", dict(labels, le=str(bound)))) for bound in buckets],
+            series(name + "_bucket", dict(labels, le="+Inf")),
+            series(name + "_sum", labels),
+            series(name + "_count", labels))
+        _histogram_keys[cache_key] = keys
+    return keys
+
+def get(name, labels=None):
+    return store.items().get(series(name, labels), 0.0)
+
+# metrics are best effort, a problem with the store must never break the caller
+def flush():
+    try:
+        store.flush()
+    except Exception as e:
+        logging.debug("unable to flush metrics: {}".format(e))
+
+HISTOGRAM_SUFFIXES = ("_bucket", "_count", "_sum")
+
+# returns the metric family of a series name and its type
+# types are not stored so they follow from the names: histograms have _bucket series and counters end in _total
+def family(name, histograms):
+    for suffix in HISTOGRAM_SUFFIXES:
+        if name.endswith(suffix) and name[:-len(suffix)] in histograms:
+            return name[:-len(suffix)], "histogram"
+    if name.endswith("_total"):
+        return name, "counter"
+    return name, "gauge"
+
+# returns every metric in the prometheus text format, values is the result of store.items() if already read
+def render(values=None):
+    if values is None:
+        values = store.items()
+    names = { key.split("{", 1)[0] for key in values }
+    histograms = { name[:-len("_bucket")] for name in names if name.endswith("_bucket") }
+
+    # every series of a family has to follow its TYPE line, buckets in increasing order of le
+    def sort_key(key):
+        name = key.split("{", 1)[0]
+        labels = re.sub(r'le="[^"]*",?', "", key[len(name):]).replace(",}", "}").replace("{}", "")
+        m = re.search(r'le="([^"]*)"', key)
+        return (family(name, histograms)[0], labels, name, float(m.group(1)) if m else 0.0)
+
+    lines = []
+    current = None
+    for key in sorted(values, key=sort_key):
+        name = key.split("{", 1)[0]
+        metric_family, metric_type = family(name, histograms)
+        if metric_family != current:
+            lines.append("# TYPE {} {}".format(metric_family, metric_type))
+            current = metric_family
+        lines.append("{} {}".format(key, repr(values[key])))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,121 @@
+import logging
+import os
+import re
+
+from chronos import CHRONOS_HOME
+from chronos.config import config
+from chronos.database import HOT_QUERIES
+
+# versioned schema changes, named <version>_<description>.sql and applied in order
+migrations_dir = os.path.join(CHRONOS_HOME, "setup", "migrations")
+
+# seconds a migration may wait for the metadata lock on a table before giving up
+# keeping this short stops a pending ALTER from stalling every query queued behind it
+lock_wait_timeout = config.getint("mysql", "migration_lock_wait_timeout", fallback=5)
+
+class MigrationError(Exception):
+    pass
+
+# returns a sorted list of (version, name, path) for every migration file
+def list_migrations():
+    migrations = []
+    for file in os.listdir(migrations_dir):
+        m = re.match(r"^(\d+)_(\w+)\.sql$", file)
+        if m is None:
+            continue
+        migrations.append((int(m.group(1)), m.group(2), os.path.join(migrations_dir, file)))
+    return sorted(migrations)
+
+# splits a migration file into statements, supports the mysql client DELIMITER command
+def split_statements(sql):
+    statements = []
+    delimiter = ";"
+    current = []
+    for line in sql.splitlines():
+        stripped = line.strip()
+        if stripped.upper().startswith("DELIMITER "):
+            delimiter = stripped.split(None, 1)[1]
+            continue
+        if not current and (stripped == "" or stripped.startswith("--")):
+            continue
+        if stripped.endswith(delimiter):
+            current.append(line.rstrip()[:-len(delimiter)])
+            statements.append("\n".join(current).strip())
+            current = []
+        else:
+            current.append(line)
+    if "\n".join(current).strip():
+        statements.append("\n".join(current).strip())
+    return statements
+
+def current_version(db):
+    c = db.connection.cursor()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS `schema_version` (
+            `version` int NOT NULL,
+            `name` varchar(100) NOT NULL,
+            `applied` timestamp NOT NULL DEFAULT current_timestamp,
+            PRIMARY KEY (`version`)
+        ) ENGINE=InnoDB
+        """)
+    c.execute("SELECT max(version) FROM schema_version")
+    row = c.fetchone()
+    db.connection.commit()
+    return row[0] or 0
+
+# applies all migrations newer than the current version up to target and returns the new version
+def migrate(db, target=None):
+    c = db.connection.cursor()
+
+    # only one migration may run at a time, even across hosts
+    c.execute("SELECT GET_LOCK('chronos_migrate', 0)")
+    if c.fetchone()[0] != 1:
+        raise MigrationError("another migration is already running")
+
+    try:
+        c.execute("SET SESSION lock_wait_timeout = %s", (lock_wait_timeout,))
+        version = current_version(db)
+        for migration_version, name, path in list_migrations():
+            if migration_version <= version:
+                continue
+            if target is not None and migration_version > target:
+                break
+
+            logging.info("applying migration {} {}".format(migration_version, name))
+            with open(path, "r") as fh:
+                statements = split_statements(fh.read())
+
+            # DDL commits implicitly so each migration is recorded as soon as it is applied
+            # a migration that fails part way must be finished by hand before running again
+            for statement in statements:
+                try:
+                    c.execute(statement)
+                except Exception as e:
+                    raise MigrationError("migration {} {} failed: {}".format(migration_version, name, e))
+            c.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (migration_version, name))
+            db.connection.commit()
+            version = migration_version
+    finally:
+        c.execute("SELECT RELEASE_LOCK('chronos_migrate')")
+        db.connection.commit()
+
+    return version
+
+# returns a list of (name, table, access type) for every hot query that does not use an index
+def check_plans(db):
+    failures = []
+    c = db.connection.cursor()
+    for name, sql, params in HOT_QUERIES:
+        c.execute("EXPLAIN {}".format(sql), params)
+        columns = [d[0] for d in c.description]
+        for row in c.fetchall():
+            plan = dict(zip(columns, row))
+            # derived tables and union results are built in memory from rows already checked
+            if plan.get("table") is None or plan.get("table").startswith("<"):
+                continue
+            # a full index scan of tasks reads every row just like a table scan
+            full_index_scan = plan.get("type") == "index" and plan.get("table") == "tasks"
+            if plan.get("type") == "ALL" or plan.get("key") is None or full_index_scan:
+                failures.append((name, plan.get("table"), plan.get("type")))
+    db.connection.commit()
+    return failures
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import select
+import socket
+
+from multiprocessing import Condition, Value
+
+from chronos import CHRONOS_HOME
+from chronos.config import config
+
+# unix datagram socket the daemon listens on for task events
+socket_path = config.get("chronos", "notify_socket", fallback=os.path.join(CHRONOS_HOME, "chronos.sock"))
+
+# longest an idle worker or lock manager waits before checking the database anyway
+idle_timeout = config.getint("chronos", "idle_timeout", fallback=30)
+
+# per process socket used to send events
+_sender = None
+_sender_pid = None
+
+def notify(event, **kwargs):
+    # tell the daemon something happened, this is best effort
+    # if the daemon is not listening the change is still picked up after idle_timeout
+    global _sender, _sender_pid
+    message = dict(kwargs, event=event)
+    try:
+        if _sender is None or _sender_pid != os.getpid():
+            _sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            _sender.setblocking(False)
+            _sender_pid = os.getpid()
+        _sender.sendto(json.dumps(message).encode('utf-8'), socket_path)
+    except Exception as e:
+        logging.debug("unable to send {} event: {}".format(event, e))
+
+class Listener(object):
+    def __init__(self):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(socket_path)
+        self.socket.setblocking(False)
+        # the web service usually runs as another user, events only trigger wakeups so anyone may send them
+        os.chmod(socket_path, 0o666)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # waits up to timeout seconds for events and returns all that are pending
+    def wait(self, timeout):
+        events = []
+        readable, _, _ = select.select([self.socket], [], [], max(timeout, 0))
+        if not readable:
+            return events
+        while True:
+            try:
+                data = self.socket.recv(4096)
+            except BlockingIOError:
+                break
+            try:
+                events.append(json.loads(data.decode('utf-8')))
+            except Exception as e:
+                logging.warning("ignoring malformed event: {}".format(e))
+        return events
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.remove(socket_path)
+        except OSError:
+            pass
+
+class Wakeup(object):
+    # lets the daemon wake idle workers without them missing a wakeup sent while they were busy
+    def __init__(self):
+        self.condition = Condition()
+        self.generation = Value('L', 0, lock=False)
+
+    # returns a marker to pass to wait, take it before looking for work
+    def mark(self):
+        return self.generation.value
+
+    def wait(self, mark, timeout):
+        with self.condition:
+            if self.generation.value == mark:
+                self.condition.wait(timeout)
+
+    def notify(self):
+        with self.condition:
+            self.generation.value += 1
+            self.condition.notify_all()
@@ -0,0 +1,48 @@
+import logging
+import os
+
+from collections import namedtuple
+from configparser import ConfigParser
+from types import MappingProxyType
+
+from chronos import CHRONOS_HOME
+from chronos.config import config
+
+LockPolicy = namedtuple("LockPolicy", ["max_locks", "timeout"])
+
+class PolicyTable(object):
+    # immutable lock_type -> LockPolicy lookup compiled from the lock_type_* config sections
+    def __init__(self, default, policies):
+        self.default = default
+        self.policies = MappingProxyType(dict(policies))
+
+    def get(self, lock_type):
+        return self.policies.get(lock_type, self.default)
+
+def compile_policies(config):
+    default = LockPolicy(config.getint("lock_type_default", "max_locks"), config.getint("lock_type_default", "timeout"))
+    policies = {}
+    for section in config.sections():
+        if not section.startswith("lock_type_"):
+            continue
+        policies[section[len("lock_type_"):]] = LockPolicy(
+            config.getint(section, "max_locks", fallback=default.max_locks),
+            config.getint(section, "timeout", fallback=default.timeout))
+    return PolicyTable(default, policies)
+
+# the current policy table, replaced as a whole on reload so readers never see a partial update
+policies = compile_policies(config)
+
+def get(lock_type):
+    return policies.get(lock_type)
+
+# re-reads the lock_type_* sections from the config file, the old table is kept if the new one is invalid
+def reload():
+    global policies
+    try:
+        temp = ConfigParser(allow_no_value=True)
+        temp.read(os.path.join(CHRONOS_HOME, 'config/chronos.ini'))
+        policies = compile_policies(temp)
+        logging.info("reloaded lock policies")
+    except Exception as e:
+        logging.error("unable to reload lock policies: {}".format(e))
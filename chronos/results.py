@@ -0,0 +1,87 @@
+import hashlib
+import os
+import zlib
+
+from chronos.config import config
+
+# task results are stored compressed by plugins that set result_codec in their [plugin_<name>] section
+# codec -> file extension, the codec name doubles as the http Content-Encoding of the file
+CODECS = {
+    "gzip": ".gz",
+    "deflate": ".deflate",
+}
+
+RESULT_FILE = "result"
+
+# decoded length of a compressed result, lets the web service answer range requests over the decoded result
+SIZE_FILE = "result.size"
+
+# returns the codec results of plugin are stored with, None to store them as is
+def codec_for(plugin):
+    codec = config.get("plugin_{}".format(plugin), "result_codec", fallback=None)
+    if codec not in CODECS:
+        return None
+    return codec
+
+def file_name(codec):
+    if codec is None:
+        return RESULT_FILE
+    return RESULT_FILE + CODECS[codec]
+
+def compressor(codec):
+    # http deflate is the zlib format, not a raw deflate stream
+    # zlib writes no timestamp in the gzip header so identical results compress to identical files and share a blob
+    if codec == "gzip":
+        return zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    return zlib.compressobj()
+
+def decompressor(codec):
+    if codec == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return zlib.decompressobj()
+
+# compresses content into fh a chunk at a time and returns the sha256 of what was written
+def write_encoded(codec, content, fh, chunk_size=1024*1024):
+    hasher = hashlib.sha256()
+    encoder = compressor(codec)
+    view = memoryview(content)
+    for offset in range(0, len(view), chunk_size):
+        data = encoder.compress(view[offset:offset + chunk_size])
+        hasher.update(data)
+        fh.write(data)
+    data = encoder.flush()
+    hasher.update(data)
+    fh.write(data)
+    return hasher.hexdigest()
+
+# returns the decoded length of the compressed result in directory or None if it is not known
+def decoded_size(directory):
+    try:
+        with open(os.path.join(directory, SIZE_FILE), "r") as fh:
+            return int(fh.read())
+    except (OSError, ValueError):
+        return None
+
+# returns (path, codec) of the result in directory or (None, None) if there is none
+def find(directory):
+    for codec in [None] + sorted(CODECS):
+        path = os.path.join(directory, file_name(codec))
+        if os.path.isfile(path):
+            return path, codec
+    return None, None
+
+# yields the decompressed contents of the result at path, skipping the first start bytes
+def iter_decoded(path, codec, start=0, chunk_size=64*1024):
+    decoder = decompressor(codec)
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            data = decoder.decompress(chunk)
+            if start > 0:
+                skipped = min(start, len(data))
+                data = data[skipped:]
+                start -= skipped
+            if data:
+                yield data
+    data = decoder.flush()[start:]
+    if data:
+        yield data
@@ -0,0 +1,92 @@
+import logging
+import os
+import shutil
+import time
+
+from multiprocessing import Process, Event
+from signal import signal, SIGTERM, SIGINT, SIGHUP, SIG_IGN
+
+from chronos import blobs, metrics
+from chronos.config import config
+from chronos.database import Database, summary_check_interval
+from plugins import plugins
+
+# seconds between retention passes of the daemon
+retention_interval = config.getint("retention", "interval", fallback=3600)
+
+# finished tasks archived per transaction, small batches keep row locks on the tasks table short
+batch_size = config.getint("retention", "batch_size", fallback=500)
+
+# seconds a finished task is kept, overridden per plugin with retention_ttl in [plugin_<name>]
+# 0 keeps tasks forever
+default_ttl = config.getint("retention", "ttl", fallback=0)
+
+def ttl_for(plugin):
+    return config.getint("plugin_{}".format(plugin), "retention_ttl", fallback=default_ttl)
+
+# archives one batch of expired tasks per plugin and deletes their directories
+# returns True if any plugin had a full batch, meaning there is probably more to archive
+def run_pass(db):
+    more = False
+    for plugin in sorted(plugins):
+        ttl = ttl_for(plugin)
+        if ttl <= 0:
+            continue
+
+        ids = db.select_expired_tasks(plugin, ttl, batch_size)
+        if not ids:
+            continue
+        archived = db.archive_tasks(ids)
+        if archived == 0:
+            continue
+
+        # the rows are gone so nothing reads these directories anymore
+        for id in ids:
+            shutil.rmtree(os.path.join("tasks", id[0:2], id), ignore_errors=True)
+        logging.info("archived {} {} tasks".format(archived, plugin))
+        metrics.inc("chronos_tasks_archived_total", {"plugin":plugin}, archived)
+        if len(ids) >= batch_size:
+            more = True
+
+    # blobs only the deleted directories referenced can go once the backlog is cleared
+    if not more:
+        blobs.gc()
+    return more
+
+class Retention(Process):
+    # runs retention passes in a process of its own so deleting directories and walking the blob store
+    # never holds up the lock manager, the task summary is checked against the tasks table here for the same reason
+    def __init__(self):
+        Process.__init__(self)
+        self.exit = Event()
+
+    def run(self):
+        # ignore signals meant for the daemon, use shutdown function to quit
+        signal(SIGTERM, SIG_IGN)
+        signal(SIGINT, SIG_IGN)
+        signal(SIGHUP, SIG_IGN)
+
+        next_pass = 0
+        next_summary_check = 0
+        with Database() as db:
+            while not self.exit.is_set():
+                # correct any drift of the status counts
+                if time.time() >= next_summary_check:
+                    db.check_summary()
+                    next_summary_check = time.time() + summary_check_interval
+
+                # keep going while there is a backlog
+                if time.time() >= next_pass:
+                    more = False
+                    try:
+                        more = run_pass(db)
+                    except Exception as e:
+                        logging.error("retention pass failed: {}".format(e))
+                    next_pass = time.time() + (0 if more else retention_interval)
+
+                metrics.flush()
+                self.exit.wait(max(min(next_pass, next_summary_check) - time.time(), 0))
+
+    # safely stops the retention process
+    def shutdown(self):
+        self.exit.set()
@@ -0,0 +1,127 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+import traceback
+
+from datetime import datetime
+
+from chronos import metrics
+from chronos.config import config
+from chronos.database import Database
+
+# most async tasks a single worker drives at the same time
+max_async_tasks = config.getint("chronos", "max_async_tasks", fallback=100)
+
+# runs a blocking call such as a CbApi request in a thread so it does not stall the event loop
+async def run_blocking(function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+class AsyncRunner(object):
+    # runs plugins with an async process function on an event loop in a background thread of the worker
+    # a task stays running while its coroutine waits, so there is no delay/claim cycle between steps
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.database = None
+        self.ready = threading.Event()
+        # tasks submitted and not finished yet, the worker stops claiming while max_async_tasks of them are in flight
+        self.active = set()
+        self.changed = threading.Condition()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="async_runner", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+
+        # pymysql connections can not be shared between threads so async tasks get their own
+        with Database() as db:
+            self.database = db
+            self.ready.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+
+    # True if the runner is driving as many tasks as it may
+    def full(self):
+        with self.changed:
+            return len(self.active) >= max_async_tasks
+
+    # waits until the runner has room for another task or timeout seconds pass
+    def wait_for_room(self, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: len(self.active) < max_async_tasks, timeout)
+
+    # runs the task until it finishes or its lock times out at timeout_time
+    def submit(self, task, plugin, timeout_time):
+        if self.loop is None:
+            self.start()
+        task.database = self.database
+        with self.changed:
+            self.active.add(task)
+        asyncio.run_coroutine_threadsafe(self.process(task, plugin, timeout_time), self.loop)
+
+    async def process(self, task, plugin, timeout_time):
+        try:
+            # an async task is never re-claimed, so the lock timeout has to be enforced here
+            timeout = (timeout_time - datetime.now()).total_seconds()
+            start = time.time()
+            try:
+                status = await asyncio.wait_for(plugin.process(task), max(timeout, 0))
+            except asyncio.TimeoutError:
+                logging.info("task {} lock timed out".format(task.id))
+                metrics.inc("chronos_lock_timeouts_total", {"plugin":task.plugin})
+                plugin.on_lock_timeout(task)
+                return
+            metrics.observe("chronos_process_seconds", time.time() - start, {"plugin":task.plugin})
+            task.flush()
+
+            # if the plugin did not return a status then mark task as complete
+            if status is None:
+                task.complete()
+
+        # hand the task back to the queue if the worker is shutting down
+        except asyncio.CancelledError:
+            task.delay(0)
+            raise
+
+        # report plugin failure
+        except Exception as e:
+            task.fail(str(e))
+            traceback.print_exc()
+
+        finally:
+            self.finished(task)
+
+    def finished(self, task):
+        with self.changed:
+            self.active.discard(task)
+            self.changed.notify_all()
+
+    async def cancel_all(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # a coroutine cancelled before it started never ran its handler, hand those tasks back here
+        with self.changed:
+            unstarted = list(self.active)
+        for task in unstarted:
+            task.delay(0)
+            self.finished(task)
+        self.loop.stop()
+
+    # cancels all in flight tasks and stops the event loop
+    def stop(self):
+        if self.loop is None:
+            return
+        logging.debug("stopping async runner")
+        asyncio.run_coroutine_threadsafe(self.cancel_all(), self.loop)
+        self.thread.join()
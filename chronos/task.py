@@ -1,48 +1,136 @@
 import json
 import os
+from collections import OrderedDict
+
+from chronos import blobs, metrics, results
+from chronos.config import config
+
+# parsed requests of recently seen tasks, a request never changes so a task re-entered after a delay reuses it
+request_cache_size = config.getint("chronos", "request_cache_size", fallback=1000)
+request_cache = OrderedDict()
+
+# every variable of a task is kept in this one file, older tasks may still have a file per variable
+STATE_FILE = "state.json"
 
 class Task(object):
     @property
     def request(self):
         if self._request is None:
-            request_path = os.path.join(self.directory, "request.json")
-            with open(request_path, "r") as fh:
-                self._request = json.load(fh)
+            if self.id in request_cache:
+                request_cache.move_to_end(self.id)
+                self._request = request_cache[self.id]
+            else:
+                request_path = os.path.join(self.directory, "request.json")
+                with open(request_path, "r") as fh:
+                    self._request = json.load(fh)
+                request_cache[self.id] = self._request
+                if len(request_cache) > request_cache_size:
+                    request_cache.popitem(last=False)
         return self._request
 
-    def __init__(self, database, id, plugin, lock_type, locked_at):
+    @property
+    def state(self):
+        if self._state is None:
+            path = os.path.join(self.directory, STATE_FILE)
+            self._state = {}
+            if os.path.isfile(path):
+                with open(path, "r") as fh:
+                    self._state = json.load(fh)
+        return self._state
+
+    def __init__(self, database, id, plugin, lock_type, locked_at, claim_id=None):
         self.database = database
         self.id = id
         self.plugin = plugin
         self.lock_type = lock_type
         self.locked_at = locked_at
+        self.claim_id = claim_id
         self.directory = os.path.join("tasks", self.id[0:2], self.id)
         self._request = None
+        self._state = None
+        self._dirty = False
 
     def get_var(self, name):
-        path = os.path.join(self.directory, name)
-        value = {name:None}
-        if os.path.isfile(path):
-            with open(path, "r") as fh:
-                value = json.load(fh)
-        return value[name]
+        if name not in self.state:
+            # fall back to the file per variable layout of older tasks
+            path = os.path.join(self.directory, name)
+            value = {name:None}
+            if os.path.isfile(path):
+                with open(path, "r") as fh:
+                    value = json.load(fh)
+            return value[name]
+        return self.state[name]
 
+    # variables are only written to disk when the task is flushed
     def set_var(self, name, value):
-        path = os.path.join(self.directory, name)
-        with open(path, "w") as fh:
-            json.dump({name:value}, fh)
+        self.state[name] = value
+        self._dirty = True
+
+    # writes any changed variables to the state file, readers see either the old or the new file
+    def flush(self):
+        if not self._dirty:
+            return
+        path = os.path.join(self.directory, STATE_FILE)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "w") as fh:
+            json.dump(self._state, fh)
+        os.replace(temp_path, path)
+        self._dirty = False
 
     def create_file(self, rel_path, content, clobber=True):
+        # the result is compressed with the codec configured for the plugin
+        if rel_path == results.RESULT_FILE:
+            codec = results.codec_for(self.plugin)
+            if codec is not None:
+                self.create_result(codec, content, clobber)
+                return
         path = os.path.join(self.directory, rel_path)
         if not os.path.isfile(path) or clobber:
-            with open(path, "wb") as fh:
+            # larger files are stored once in the blob store and linked into every task that has them
+            if len(content) >= blobs.min_size:
+                blobs.link(blobs.store_bytes(content), path)
+                return
+            # path may be a link to a shared blob so it is replaced, never written through
+            temp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(temp_path, "wb") as fh:
                 fh.write(content)
+            os.replace(temp_path, path)
+
+    # compresses content into the result file a chunk at a time instead of building the compressed copy in memory
+    def create_result(self, codec, content, clobber=True):
+        path = os.path.join(self.directory, results.file_name(codec))
+        if os.path.isfile(path) and not clobber:
+            return
+
+        # the decoded size is written first so it is there as soon as the result is
+        size_path = os.path.join(self.directory, results.SIZE_FILE)
+        temp_path = "{}.{}.tmp".format(size_path, os.getpid())
+        with open(temp_path, "w") as fh:
+            fh.write(str(len(content)))
+        os.replace(temp_path, size_path)
+
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(temp_path, "wb") as fh:
+                digest = results.write_encoded(codec, content, fh)
+            if os.path.getsize(temp_path) >= blobs.min_size:
+                blobs.link(blobs.store_file(temp_path, digest), path)
+            else:
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
 
+    # state is flushed before the status changes so whoever picks the task up next sees it
     def delay(self, seconds, unlock=False):
-        return self.database.delay_task(self.id, seconds, unlock)
+        self.flush()
+        metrics.inc("chronos_task_delays_total", {"plugin":self.plugin})
+        return self.database.delay_task(self.id, seconds, unlock, self.lock_type)
 
     def fail(self, error):
-        return self.database.fail_task(self.id, error)
+        self.flush()
+        return self.database.fail_task(self.id, error, self.lock_type)
 
     def complete(self):
-        return self.database.complete_task(self.id)
+        self.flush()
+        return self.database.complete_task(self.id, self.lock_type)
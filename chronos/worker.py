@@ -1,41 +1,94 @@
+import asyncio
 import logging
+import os
+import socket
 import traceback
 import time
 
+from collections import deque
 from datetime import timedelta, datetime
 from multiprocessing import Process, Event
-from signal import signal, SIGTERM, SIGINT
+from signal import signal, pthread_sigmask, SIGTERM, SIGINT, SIGHUP, SIG_UNBLOCK
 
+from chronos import metrics, policy
 from chronos.config import config
 from chronos.database import Database
+from chronos.notify import idle_timeout
+from chronos.runner import AsyncRunner
 from plugins import plugins
 
+# name of this chronos daemon, used to tag the tasks its workers claim
+node = config.get("chronos", "node", fallback=socket.gethostname())
+
+# number of tasks a worker claims at once and how long it may hold them before starting
+prefetch = config.getint("chronos", "prefetch", fallback=1)
+claim_lease = config.getint("chronos", "claim_lease", fallback=60)
+
 def ignore_signal(signum, frame):
     pass
 
+def reload_policies(signum, frame):
+    policy.reload()
+
 class Worker(Process):
-    def __init__(self, lock):
+    def __init__(self, wakeup):
         Process.__init__(self)
-        self.lock = lock
+        self.wakeup = wakeup
         self.exit = Event()
+        self.claims = 0
+        self.queue = deque()
+        self.runner = AsyncRunner()
+
+    # returns a unique id for the next claim made by this worker
+    def next_claim_id(self):
+        self.claims += 1
+        return "{}:{}:{}".format(node, os.getpid(), self.claims)
 
     def run(self):
         # ignore term and int signals, use shutdown function to quit
         signal(SIGTERM, ignore_signal)
         signal(SIGINT, ignore_signal)
 
+        # the daemon forwards hangups so lock policies can be tuned without a restart
+        # they are blocked until now, see spawn_worker
+        signal(SIGHUP, reload_policies)
+        pthread_sigmask(SIG_UNBLOCK, {SIGHUP})
+
         # connect to the database
         with Database() as db:
+            claim_id = None
+
             # keep processing until told to stop
             while not self.exit.is_set():
-                # get the next task using a lock to prevent duplicate processing
-                self.lock.acquire()
-                task = db.get_next_task()
-                self.lock.release()
-
-                # continue if the are no available tasks
-                if task is None:
-                    time.sleep(1)
+                # a full runner means every task started now would sit waiting while its lock timeout runs
+                # so hand back the claimed tasks for other workers and wait for room
+                if self.runner.full():
+                    if claim_id is not None and self.queue:
+                        db.release_tasks(claim_id)
+                        self.queue.clear()
+                    self.runner.wait_for_room(1)
+                    continue
+
+                # refill the local queue with a batch of tasks, the claim is atomic so no lock is needed
+                if not self.queue:
+                    mark = self.wakeup.mark()
+                    claim_id = self.next_claim_id()
+                    claimed = db.claim_tasks(claim_id, prefetch, claim_lease)
+                    # seconds each task waited for a worker after it was locked
+                    now = datetime.now()
+                    for task in claimed:
+                        metrics.observe("chronos_claim_wait_seconds", (now - task.locked_at).total_seconds(), {"lock_type":task.lock_type})
+                    self.queue.extend(claimed)
+
+                # wait for the daemon to tell us there is work if there are no available tasks
+                if not self.queue:
+                    metrics.flush()
+                    self.wakeup.wait(mark, idle_timeout)
+                    continue
+
+                # skip the task if our claim expired and another worker took it
+                task = self.queue.popleft()
+                if not db.start_task(task):
                     continue
 
                 try:
@@ -43,19 +96,25 @@ class Worker(Process):
                     plugin = plugins[task.plugin]
 
                     # determine timeout time
-                    timeout = config.getint("lock_type_default", "timeout")
-                    if config.has_option("lock_type_{}".format(task.lock_type), "timeout"):
-                        timeout = config.getint("lock_type_{}".format(task.lock_type), "timeout")
-                    timeout_time = task.locked_at + timedelta(seconds=timeout)
+                    timeout_time = task.locked_at + timedelta(seconds=policy.get(task.lock_type).timeout)
 
                     # check if task has timed out
                     if datetime.now() > timeout_time:
                         logging.info("task {} lock timed out".format(task.id))
+                        metrics.inc("chronos_lock_timeouts_total", {"plugin":task.plugin})
                         plugin.on_lock_timeout(task)
                         continue
 
+                    # async plugins run on the event loop so one worker can drive many of them
+                    if asyncio.iscoroutinefunction(plugin.process):
+                        self.runner.submit(task, plugin, timeout_time)
+                        continue
+
                     # run the task
+                    start = time.time()
                     status = plugin.process(task)
+                    metrics.observe("chronos_process_seconds", time.time() - start, {"plugin":task.plugin})
+                    task.flush()
 
                     # if the plugin did not return a status then mark task as complete
                     if status is None:
@@ -66,7 +125,16 @@ class Worker(Process):
                     task.fail(str(e))
                     traceback.print_exc()
 
+            # return any claimed tasks we did not get to
+            if claim_id is not None and self.queue:
+                db.release_tasks(claim_id)
+
+            # requeue any async tasks still in flight
+            self.runner.stop()
+            metrics.flush()
+
 
     # safely stops the worker
     def shutdown(self):
         self.exit.set()
+        self.wakeup.notify()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import os
+import sys
+import argparse
+
+import chronos
+
+sys.dont_write_bytecode = True
+
+parser = argparse.ArgumentParser(description="Chronos schema migrations")
+parser.add_argument('--chronos-home', required=False, dest='chronos_home', default=None,
+    help="Sets the location of chronos. Defaults to /opt/chronos")
+parser.add_argument('-t', '--target', required=False, dest='target', default=None, type=int,
+    help="Only apply migrations up to this version.")
+parser.add_argument('-s', '--status', required=False, dest='status', default=False, action='store_true',
+    help="Show the current schema version and pending migrations without applying them.")
+parser.add_argument('-c', '--check-plans', required=False, dest='check_plans', default=False, action='store_true',
+    help="Fail if any hot query would scan the whole tasks table.")
+args = parser.parse_args()
+
+if args.chronos_home:
+    chronos.CHRONOS_HOME = args.chronos_home
+
+# this is built to run out of this directory
+try:
+    os.chdir(chronos.CHRONOS_HOME)
+except Exception as e:
+    sys.stderr.write("unable to cd to {}: {}\n".format(chronos.CHRONOS_HOME, e))
+    sys.exit(1)
+
+from chronos.database import Database
+from chronos.migrate import MigrationError, check_plans, current_version, list_migrations, migrate
+
+with Database() as db:
+    if args.status:
+        version = current_version(db)
+        print("schema version {}".format(version))
+        for migration_version, name, path in list_migrations():
+            if migration_version > version:
+                print("pending {} {}".format(migration_version, name))
+        sys.exit(0)
+
+    if args.check_plans:
+        failures = check_plans(db)
+        for name, table, access_type in failures:
+            print("{} scans {} ({})".format(name, table, access_type))
+        sys.exit(1 if failures else 0)
+
+    try:
+        version = migrate(db, args.target)
+        print("schema version {}".format(version))
+    except MigrationError as e:
+        sys.stderr.write("{}\n".format(e))
+        sys.exit(1)
@@ -3,40 +3,231 @@ import json
 import logging
 import os
 import sys
+import tempfile
+import threading
+import time
 
 from datetime import datetime
-from hashlib import md5
+from hashlib import md5, sha256
 
+from chronos import blobs, metrics, results
 from chronos.config import config
-from chronos.database import Database
+from chronos.database import ConnectionPool, Database, PoolTimeout, STATUS_DONE
+from chronos.hashing import task_id
 from plugins import plugins
 
-from flask import Flask, abort, request
+from flask import Flask, Response, abort, request, send_file
 
 sys.dont_write_bytecode = True
 
 # The web service
 chronos = Flask(__name__)
 
+# database connections shared by the requests handled in this process
+pool = ConnectionPool(
+    config.getint("chronos", "web_pool_size", fallback=10),
+    timeout=config.getint("chronos", "web_pool_timeout", fallback=10),
+    check_idle=config.getint("chronos", "web_pool_check_idle", fallback=1))
+
 # hello world page that displays some simple stats
 @chronos.route("/chronos")
 def display_stats():
     stats = ""
-    with Database() as db:
+    with Database(pool) as db:
         for stat in db.select_statistics():
             stats += "{}: {}\n".format(stat[0], stat[1])
     return stats
 
+# longest a long poll request is held and seconds between checks of everything held requests wait on
+long_poll_max = config.getint("chronos", "long_poll_max", fallback=60)
+long_poll_interval = config.getfloat("chronos", "long_poll_interval", fallback=1)
+
+# most requests of this process held in a long poll at once, every one of them ties up a web server thread
+# so this must stay below the number of threads or keep alives and releases can not get through
+long_poll_max_waiting = config.getint("chronos", "long_poll_max_waiting", fallback=12)
+long_poll_slots = threading.BoundedSemaphore(long_poll_max_waiting)
+
+# what a long poll can wait on, kind -> query returning a dict of id -> status for a list of ids
+LONG_POLL_CHECKS = {
+    "task": Database.select_statuses,
+    "lock": Database.select_lock_statuses,
+}
+
+class Watcher(object):
+    # checks everything the long polls of this process wait on from one thread, one query per kind every
+    # long_poll_interval seconds however many requests are waiting
+    def __init__(self):
+        self.condition = threading.Condition()
+        # (kind, id) -> number of requests waiting on it and the status last seen
+        self.waiting = {}
+        self.results = {}
+        # counts checks so a request knows when a new result is in
+        self.generation = 0
+        self.pid = None
+
+    def watch(self, key):
+        with self.condition:
+            # the thread does not survive a fork of the web server, start one per process
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, daemon=True).start()
+            self.waiting[key] = self.waiting.get(key, 0) + 1
+            return self.generation
+
+    def unwatch(self, key):
+        with self.condition:
+            self.waiting[key] -= 1
+            if self.waiting[key] == 0:
+                del self.waiting[key]
+                self.results.pop(key, None)
+
+    # waits up to timeout seconds for a check newer than generation, returns the latest generation and status
+    def wait(self, key, generation, timeout):
+        with self.condition:
+            if self.generation == generation:
+                self.condition.wait(timeout)
+            return self.generation, self.results.get(key)
+
+    def run(self):
+        while True:
+            time.sleep(long_poll_interval)
+            with self.condition:
+                keys = list(self.waiting)
+            if not keys:
+                continue
+
+            results = {}
+            try:
+                with Database(pool) as db:
+                    for kind, check in LONG_POLL_CHECKS.items():
+                        ids = [id for key_kind, id in keys if key_kind == kind]
+                        if ids:
+                            statuses = check(db, ids)
+                            results.update(((kind, id), statuses[id]) for id in ids if id in statuses)
+            except Exception as e:
+                logging.error("failed to check long polls: {}".format(e))
+
+            with self.condition:
+                for key, result in results.items():
+                    if key in self.waiting:
+                        self.results[key] = result
+                self.generation += 1
+                self.condition.notify_all()
+
+watcher = Watcher()
+
+# returns the status of the kind of thing with id once done(status) is true or timeout seconds pass
+# returns None if there is no such thing
+# the first check is made right away, after that the request waits on the checks made by the watcher
+# when every long poll slot is taken the current status is returned right away
+def long_poll(kind, id, done, timeout):
+    id = id.upper()
+    with Database(pool) as db:
+        result = LONG_POLL_CHECKS[kind](db, [id]).get(id)
+    if result is None or done(result):
+        return result
+
+    held = long_poll_slots.acquire(blocking=False)
+    if not held:
+        return result
+    key = (kind, id)
+    try:
+        deadline = time.time() + min(timeout, long_poll_max)
+        generation = watcher.watch(key)
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return result
+                generation, status = watcher.wait(key, generation, remaining)
+                # a failed check leaves the status unknown, keep the last one seen
+                if status is not None:
+                    result = status
+                if done(result):
+                    return result
+        finally:
+            watcher.unwatch(key)
+    finally:
+        long_poll_slots.release()
+
+# returns the metrics shared by every chronos process in the prometheus text format
+@chronos.route("/chronos/metrics")
+def display_metrics():
+    values = metrics.store.items()
+    requests = values.get("chronos_task_create_requests_total", 0)
+    deduplicated = values.get("chronos_task_create_deduplicated_total", 0)
+    ratio = deduplicated / requests if requests else 0.0
+    ratio_lines = "# TYPE chronos_task_create_dedup_ratio gauge\nchronos_task_create_dedup_ratio {}\n".format(ratio)
+    return metrics.render(values) + ratio_lines, 200, {"Content-Type":"text/plain; version=0.0.4"}
+
+# returns the connection pool metrics of this process
+@chronos.route("/chronos/pool")
+def pool_stats():
+    return json.dumps(pool.stats())
+
 # page that returns the status of the task with given id
 @chronos.route("/chronos/task/status/<id>")
 def task_status(id):
     status = None
-    with Database() as db:
+    with Database(pool) as db:
         status = db.select_status(id)
     if status is None:
         abort(404)
     return status
 
+# records how many task create requests were made and how many of them matched an existing task
+def count_created(requested, inserted):
+    metrics.inc("chronos_task_create_requests_total", value=requested)
+    metrics.inc("chronos_task_create_deduplicated_total", value=requested - int(inserted))
+
+# task parent directories this process has already seen, saves a stat per task created
+known_dirs = set()
+
+# returns the id of the task for plugin and request_json, storing the request in its task dir if it is new
+def prepare_task(plugin, request_json):
+    # calculate task id
+    id = task_id(plugin, request_json)
+    logging.debug("task id = {}".format(id))
+
+    # create task dir if it does not exist already
+    parent_dir = os.path.join("tasks", id[0:2])
+    if parent_dir not in known_dirs:
+        os.makedirs(parent_dir, exist_ok=True)
+        known_dirs.add(parent_dir)
+    task_dir = os.path.join(parent_dir, id)
+    try:
+        os.mkdir(task_dir)
+        new_dir = True
+    except FileExistsError:
+        new_dir = False
+
+    # store request json in task dir
+    request_file = os.path.join(task_dir, 'request.json')
+    if new_dir or not os.path.isfile(request_file):
+        with open(request_file, "w") as fp:
+            json.dump(request_json, fp)
+
+    return id
+
+# waits until the task with given id is complete, has failed or timeout seconds pass and returns its status
+@chronos.route("/chronos/task/wait/<id>")
+def task_wait(id):
+    timeout = request.args.get("timeout", default=30, type=float)
+    status = long_poll("task", id, lambda status: status in STATUS_DONE, timeout)
+    if status is None:
+        abort(404)
+    return status
+
+# returns a json object mapping each posted id to its status, or null if there is no such task
+@chronos.route("/chronos/task/status", methods = ["POST"])
+def task_status_many():
+    ids = request.get_json(force=True)
+    if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids):
+        abort(400)
+    with Database(pool) as db:
+        statuses = db.select_statuses(ids)
+    return json.dumps({ id: statuses.get(id.upper()) for id in ids })
+
 # queue new task and return the id
 # if the task already exists then it is not queued, just the id is returned
 @chronos.route("/chronos/task/create/<plugin>", methods = ["POST"])
@@ -51,92 +242,196 @@ def task_create(plugin):
     logging.debug("loading request json")
     request_json = request.get_json(force=True)
 
-    # calculate task id
-    logging.debug("calculating task id")
-    md5_hasher = md5()
-    md5_hasher.update(plugin.encode('utf-8'))
-    md5_hasher.update(json.dumps(request_json).encode('utf-8'))
-    id = md5_hasher.hexdigest().upper()
-    logging.debug("task id = {}".format(id))
+    id = prepare_task(plugin, request_json)
+    lock_type = plugins[plugin].lock_type()
 
-    # create task dir if it does not exist already
-    task_dir = os.path.join("tasks", id[0:2])
-    if not os.path.isdir(task_dir):
-        os.mkdir(task_dir)
-    task_dir = os.path.join(task_dir, id)
-    if not os.path.isdir(task_dir):
-        os.mkdir(task_dir)
+    # create new task
+    with Database(pool) as db:
+        count_created(1, db.insert_task(id, plugin, lock_type))
 
-    # store request json in task dir
-    request_file = os.path.join(task_dir, 'request.json')
-    if not os.path.isfile(request_file):
-        with open(request_file, "w") as fp:
-            json.dump(request_json, fp)
+    # return task id
+    return id
+
+# queue a list of [plugin, request] pairs and return a json list of their ids in the same order
+# the tasks are inserted with a single statement, existing tasks are not queued again
+@chronos.route("/chronos/task/create", methods = ["POST"])
+def task_create_many():
+    tasks = request.get_json(force=True)
+    if not isinstance(tasks, list):
+        abort(400)
+    logging.debug("request for {} new tasks".format(len(tasks)))
+
+    # make sure every plugin exists before creating anything
+    for task in tasks:
+        if not isinstance(task, list) or len(task) != 2:
+            abort(400)
+        if task[0] not in plugins:
+            logging.error("plugin not found: {}".format(task[0]))
+            abort(404)
+
+    ids = []
+    rows = []
+    for plugin, request_json in tasks:
+        id = prepare_task(plugin, request_json)
+        ids.append(id)
+        rows.append((id, plugin, plugins[plugin].lock_type()))
+
+    # create new tasks
+    with Database(pool) as db:
+        count_created(len(rows), db.insert_tasks(rows))
+
+    return json.dumps(ids)
+
+# size of the chunks an upload is read in
+upload_chunk_size = 1024 * 1024
+
+# queue new task with a file and return the id
+# the request fields are passed as query arguments and the raw file is the body, which is streamed to disk while it
+# is hashed. the digest is added to the request as content_sha256 so the task id is derived from the file contents
+@chronos.route("/chronos/task/upload/<plugin>", methods = ["POST"])
+def task_upload(plugin):
+    logging.debug("upload for new {} task".format(plugin))
+    # make sure plugin exists
+    if plugin not in plugins:
+        logging.error("plugin not found: {}".format(plugin))
+        abort(404)
+
+    request_json = request.args.to_dict()
+    fd, temp_path = tempfile.mkstemp(prefix=".upload-", dir="tasks")
+    try:
+        hasher = sha256()
+        with os.fdopen(fd, "wb") as fh:
+            while True:
+                chunk = request.stream.read(upload_chunk_size)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                fh.write(chunk)
+        request_json["content_sha256"] = hasher.hexdigest()
+
+        # keep the file as the task content unless the task already has it
+        # identical files pushed by other tasks are only stored once
+        id = prepare_task(plugin, request_json)
+        content_path = os.path.join("tasks", id[0:2], id, "content")
+        if not os.path.isfile(content_path):
+            blobs.link(blobs.store_file(temp_path, request_json["content_sha256"]), content_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
     lock_type = plugins[plugin].lock_type()
 
     # create new task
-    with Database() as db:
-        db.insert_task(id, plugin, lock_type)
+    with Database(pool) as db:
+        count_created(1, db.insert_task(id, plugin, lock_type))
 
     # return task id
     return id
 
+# streams the result from disk, supports range requests and conditional requests
+# results stored compressed are sent with a Content-Encoding or decompressed depending on Accept-Encoding
 @chronos.route("/chronos/task/result/<id>", methods = ["GET"])
 def task_result(id):
-    result_path = os.path.join("tasks", id[0:2], id, "result")
-    if not os.path.isfile(result_path):
+    result_path, codec = results.find(os.path.join("tasks", id[0:2], id))
+    if result_path is None:
         abort(404)
-    result = ""
-    with open(result_path, "rb") as fh:
-        result = fh.read()
-    return result
+    if codec is None:
+        return send_file(os.path.abspath(result_path), mimetype="application/octet-stream", conditional=True)
+
+    # compressed results are sent as stored to clients that accept the codec
+    if request.accept_encodings.quality(codec) > 0:
+        response = send_file(os.path.abspath(result_path), mimetype="application/octet-stream", conditional=True)
+        response.headers["Content-Encoding"] = codec
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+    # and decompressed on the fly for everyone else, ranges are over the decoded result so downloads can resume
+    # the bytes before the range still have to be decompressed but are not sent
+    size = results.decoded_size(os.path.dirname(result_path))
+    st = os.stat(result_path)
+    etag = "{}-{}-{}".format(int(st.st_mtime), st.st_size, size)
+    headers = {"Vary":"Accept-Encoding", "ETag":'"{}"'.format(etag)}
+    start = 0
+    if size is not None:
+        headers["Accept-Ranges"] = "bytes"
+        headers["Content-Length"] = str(size)
+        if request.range is not None and (request.if_range.etag is None or request.if_range.etag == etag):
+            byte_range = request.range.range_for_length(size)
+            if byte_range is None:
+                return "", 416, {"Content-Range":"bytes */{}".format(size)}
+            start, stop = byte_range
+            if stop == size:
+                headers["Content-Range"] = "bytes {}-{}/{}".format(start, stop - 1, size)
+                headers["Content-Length"] = str(size - start)
+            else:
+                # only open ended ranges are needed to resume, anything else gets the whole result
+                start = 0
+    response = Response(results.iter_decoded(result_path, codec, start), mimetype="application/octet-stream", headers=headers)
+    if "Content-Range" in headers:
+        response.status_code = 206
+    return response
 
 # resets the time out of the lock
 @chronos.route("/chronos/lock/keep_alive/<id>", methods = ["GET"])
 def lock_keep_alive(id):
-    with Database() as db:
+    with Database(pool) as db:
         status = db.lock_keep_alive(id)
     return ""
 
-# returns 0 if task with id is not locked and 1 if it is
+# returns 0 if the lock with id is not granted yet and 1 if it is
 @chronos.route("/chronos/lock/status/<id>", methods = ["GET"])
 def lock_status(id):
     status = None
-    with Database() as db:
+    with Database(pool) as db:
         status = db.select_lock_status(id)
     if status is None:
         abort(404)
     return str(status)
 
-# creates a new lock task and returns the id
+# waits until the lock with given id is granted or timeout seconds pass and returns its lock status
+@chronos.route("/chronos/lock/wait/<id>", methods = ["GET"])
+def lock_wait(id):
+    timeout = request.args.get("timeout", default=30, type=float)
+    status = long_poll("lock", id, lambda status: status == 1, timeout)
+    if status is None:
+        abort(404)
+    return str(status)
+
+# requests a new lease and returns its id, the lock manager grants it once a lock of lock_type is free
 @chronos.route("/chronos/lock/acquire/<lock_type>", methods = ["GET"])
 def lock_acquire(lock_type):
     logging.debug("request for new {} lock".format(lock_type))
 
     # calculate unique id
     # TODO: loop until we get unique id?
-    logging.debug("calculating task id")
+    logging.debug("calculating lock id")
     md5_hasher = md5()
     idstr = "{}{}".format(lock_type, datetime.now())
     md5_hasher.update(idstr.encode('utf-8'))
     id = md5_hasher.hexdigest().upper()
-    logging.debug("task id = {}".format(id))
+    logging.debug("lock id = {}".format(id))
 
-    # create new task
-    with Database() as db:
-        db.insert_task(id, "lock", lock_type)
+    # create new lease
+    with Database(pool) as db:
+        db.insert_lease(id, lock_type)
 
-    # return task id
+    # return lock id
     return id
 
 @chronos.route("/chronos/lock/release/<id>", methods = ['GET'])
 def lock_release(id):
-    # complete the task
-    with Database() as db:
-        db.complete_task(id)
+    with Database(pool) as db:
+        # locks acquired before leases existed are tasks, complete them instead
+        if not db.release_lease(id):
+            db.complete_task(id)
     return ""
 
+# every database connection of this process is busy, the client should try again shortly
+@chronos.errorhandler(PoolTimeout)
+def pool_timeout(error):
+    logging.warning("Service Unavailable - {}".format(error))
+    return "(503) Service Unavailable\n", 503, {"Retry-After":"1"}
+
 # handles internal server errors
 @chronos.errorhandler(500)
 def internal_error(error):
@@ -146,4 +441,5 @@ def internal_error(error):
 # start the web service if running from cmdline
 if __name__ == "__main__":
     port = config.getint("chronos", "port")
-    chronos.run(host='0.0.0.0', port=port)
+    # long poll requests hold a thread each
+    chronos.run(host='0.0.0.0', port=port, threaded=True)
@@ -1,5 +1,5 @@
-import base64
 import json
+import os
 import time
 
 import requests
@@ -14,6 +14,9 @@ NO_LOCK = '0'
 STATUS_LOCKED = '1'
 STATUS_UNLOCKED = '0'
 
+# task statuses that will not change again
+TASK_DONE = ('complete', 'error', 'timed_out')
+
 class Chronos(object):
     def __init__(self, server):
         self.server = server.rstrip("/")
@@ -21,18 +24,31 @@ class Chronos(object):
             self.server = "http://{}".format(self.server)
         self.session = requests.Session()
 
-    def lock_acquire(self, lock_type, block=True, callback=None):
+    # if block is set this waits for the lock to be granted, callback is checked every poll_timeout seconds
+    # and the lock request is abandoned if it returns True
+    def lock_acquire(self, lock_type, block=True, callback=None, poll_timeout=30):
         r = self.session.get("%s/chronos/lock/acquire/%s" % (self.server, lock_type))
         r.raise_for_status()
         lock_id = r.text
         if block:
-            while self.lock_status(lock_id) == "0":
+            while True:
+                start = time.time()
+                if self.lock_wait(lock_id, poll_timeout) != "0":
+                    break
                 if callback and callback():
                     self.lock_release(lock_id)
                     return None
-                time.sleep(1)
+                # a busy server answers without holding the request, poll again in a second rather than right away
+                if time.time() - start < min(poll_timeout, 1):
+                    time.sleep(min(poll_timeout, 1) - (time.time() - start))
         return lock_id
 
+    # returns the lock status as soon as the lock is granted or after timeout seconds
+    def lock_wait(self, lock_id, timeout=30):
+        r = self.session.get("%s/chronos/lock/wait/%s" % (self.server, lock_id), params={"timeout":timeout})
+        r.raise_for_status()
+        return r.text
+
     def lock_status(self, lock_id):
         r = self.session.get("%s/chronos/lock/status/%s" % (self.server, lock_id))
         r.raise_for_status()
@@ -53,16 +69,105 @@ class Chronos(object):
         r.raise_for_status()
         return r.text
 
+    # creates a list of (task_type, data) pairs in one request and returns their ids in the same order
+    def task_create_many(self, tasks):
+        headers = {"Content-Type":"application/json"}
+        jdata = json.dumps([[task_type, data] for task_type, data in tasks])
+        r = self.session.post("%s/chronos/task/create" % (self.server), headers=headers, data=jdata)
+        r.raise_for_status()
+        return r.json()
+
     def task_status(self, task_id):
         r = self.session.get("%s/chronos/task/status/%s" % (self.server, task_id))
         r.raise_for_status()
         return r.text
 
+    # waits for the task to be complete or fail and returns its status
+    # returns the current status if timeout seconds pass first, waits forever if timeout is None
+    def task_wait(self, task_id, timeout=None, poll_timeout=30):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = poll_timeout if deadline is None else max(min(poll_timeout, deadline - time.time()), 0)
+            start = time.time()
+            r = self.session.get("%s/chronos/task/wait/%s" % (self.server, task_id), params={"timeout":wait})
+            r.raise_for_status()
+            status = r.text
+            if status in TASK_DONE or (deadline is not None and time.time() >= deadline):
+                return status
+            # a busy server answers without holding the request, poll again in a second rather than right away
+            if time.time() - start < min(wait, 1):
+                time.sleep(min(wait, 1) - (time.time() - start))
+
+    # returns a dict of task_id -> status, None for ids the server does not know
+    def task_status_many(self, task_ids):
+        headers = {"Content-Type":"application/json"}
+        r = self.session.post("%s/chronos/task/status" % (self.server), headers=headers, data=json.dumps(list(task_ids)))
+        r.raise_for_status()
+        return r.json()
+
+    # waits for all tasks to finish and returns a dict of task_id -> final status
+    # only the tasks still pending are polled, returns early with whatever is pending if timeout expires
+    def wait_all(self, task_ids, interval=1, timeout=None):
+        statuses = {}
+        pending = list(task_ids)
+        deadline = None if timeout is None else time.time() + timeout
+        while pending:
+            for task_id, status in self.task_status_many(pending).items():
+                statuses[task_id] = status
+            pending = [task_id for task_id in pending if statuses[task_id] is not None and statuses[task_id] not in TASK_DONE]
+            if not pending or (deadline is not None and time.time() >= deadline):
+                break
+            time.sleep(interval)
+        return statuses
+
     def task_result(self, task_id):
         r = self.session.get("%s/chronos/task/result/%s" % (self.server, task_id))
         r.raise_for_status()
         return r.content
 
+    # streams the result of a task to dest_path in chunks
+    # a partial download already at dest_path is resumed from where it stopped, the ETag of the result it came
+    # from is kept in dest_path.etag and sent as If-Range so a result that changed is downloaded again in full
+    # identity encoding keeps range offsets in terms of the file written to dest_path, the server decompresses
+    # compressed results and still honors the range
+    def download_result(self, task_id, dest_path, chunk_size=1024*1024):
+        url = "%s/chronos/task/result/%s" % (self.server, task_id)
+        etag_path = "{}.etag".format(dest_path)
+        headers = {"Accept-Encoding":"identity"}
+        # without the ETag there is no telling what the local file is part of, so it is downloaded again
+        if os.path.isfile(dest_path) and os.path.isfile(etag_path):
+            with open(etag_path, "r") as fh:
+                headers["If-Range"] = fh.read()
+            headers["Range"] = "bytes={}-".format(os.path.getsize(dest_path))
+        r = self.session.get(url, headers=headers, stream=True)
+
+        # the local file is complete if it is as long as the result, otherwise it is not part of it
+        if r.status_code == 416:
+            total = r.headers.get("Content-Range", "").rpartition("/")[2]
+            r.close()
+            if total == str(os.path.getsize(dest_path)):
+                return dest_path
+            del headers["Range"]
+            del headers["If-Range"]
+            r = self.session.get(url, headers=headers, stream=True)
+
+        with r:
+            r.raise_for_status()
+
+            # the server sends the whole file if it does not honor the range or the result changed
+            mode = "ab" if r.status_code == 206 else "wb"
+            if mode == "wb":
+                etag = r.headers.get("ETag")
+                if etag:
+                    with open(etag_path, "w") as fh:
+                        fh.write(etag)
+                elif os.path.isfile(etag_path):
+                    os.remove(etag_path)
+            with open(dest_path, mode) as fh:
+                for chunk in r.iter_content(chunk_size):
+                    fh.write(chunk)
+        return dest_path
+
     def collect_file(self, hostname, location):
         data = {"hostname":hostname,"location":location}
         return self.task_create("collect_file", data)
@@ -71,12 +176,14 @@ class Chronos(object):
         data = {"hostname":hostname,"cmdline":cmdline}
         return self.task_create("execute_command", data)
 
+    # streams the file to the server instead of embedding it in the request
     def put_file(self, hostname, file_path, destination):
-        content = ""
+        headers = {"Content-Type":"application/octet-stream"}
+        params = {"hostname":hostname, "destination":destination}
         with open(file_path, "rb") as fh:
-            content = base64.b64encode(fh.read())
-        data = {"hostname":hostname, "content":content, "destination":destination}
-        return self.task_create("put_file", data)
+            r = self.session.post("%s/chronos/task/upload/put_file" % (self.server), headers=headers, params=params, data=fh)
+        r.raise_for_status()
+        return r.text
 
     def remediate_emails(self, emails):
         data = {"emails":emails}
@@ -3,6 +3,8 @@ import logging
 from chronos.cbapi import CbApi
 from chronos.config import config
 
+# locks are leases in the locks table now, this only drains lock tasks created before the upgrade
+
 def lock_type():
     return 'default'
 
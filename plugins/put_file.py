@@ -2,8 +2,8 @@ import base64
 import logging
 import os
 
-from chronos.cbapi import CbApi
-from chronos.config import config
+from chronos.cb import find_command, get_client, resolve_sensor, wait_for_command, wait_for_session
+from chronos.runner import run_blocking
 
 from requests.exceptions import HTTPError
 
@@ -13,78 +13,54 @@ def lock_type():
 def on_lock_timeout(task):
     task.delay(60, True)
 
-def process(task):
+async def process(task):
     # read request
     hostname = task.request['hostname']
-    content = task.request['content']
     destination = task.request['destination']
 
-    # create file from request
-    task.create_file("content", base64.b64decode(content), clobber=False)
+    # uploaded files are already in the task dir, older requests carry the file in the request
+    if 'content' in task.request:
+        await run_blocking(task.create_file, "content", base64.b64decode(task.request['content']), clobber=False)
 
-    # create cb interface
-    url = config.get('carbon_black', 'url')
-    token = config.get('carbon_black', 'token')
-    cb = CbApi(url, ssl_verify=False, token=token)
+    # get the shared cb interface
+    cb = get_client()
 
     # get sensor id if we do not already have one
-    sensors = cb.sensors({"hostname":hostname})
-    if len(sensors) > 0:
-        sensor_id = sensors[0]['id']
-        logging.debug("resolved {} to sensor {}".format(hostname, sensor_id))
-    else:
+    sensor_id = await run_blocking(resolve_sensor, hostname)
+    if sensor_id is None:
         return task.fail("could not find sensor for {}".format(hostname))
+    logging.debug("resolved {} to sensor {}".format(hostname, sensor_id))
 
-    # get session if we do not already have one
-    session = None
-    for sess in cb.live_response_session_list():
-        if sess['sensor_id'] == sensor_id and (sess['status'] == 'active' or sess['status'] == 'pending'):
-            logging.debug("found existing session")
-            session = sess
-            break
+    # wait for the shared session for this sensor to become active
+    session = await wait_for_session(sensor_id)
     if session is None:
-        logging.debug("no existing sessions found. creating new session")
-        session = cb.live_response_session_create(sensor_id)
+        return task.delay(0)
 
     session_id = session['id']
     logging.debug("using session {}".format(session_id))
 
-    # check session status
-    status = session['status']
-    logging.debug("session status is {}".format(status))
-    if status == 'pending':
-        return task.delay(10)
-    elif status != 'active':
-        return task.delay(0)
-
     # get command if we do not already have one
-    command = None
-    for cmd in cb.live_response_session_command_list(session_id):
-        if cmd['name'] == 'put file' and cmd['object'] == destination:
-            logging.debug("found existing command")
-            command = cmd
-            break
+    command = await run_blocking(find_command, session_id, 'put file', destination)
     if command is None:
         logging.debug("no existing commands found")
 
         # upload the file to carbon black
         logging.debug("uploading file to carbon black")
         path = os.path.join(task.directory, "content")
-        file_id = cb.live_response_session_command_put_file(session_id, path)
+        file_id = await run_blocking(cb.live_response_session_command_put_file, session_id, path)
 
         logging.debug("creating new command")
         options = [destination, {"file_id":file_id}]
-        command = cb.live_response_session_command_post(session_id, 'put file', options)
+        command = await run_blocking(cb.live_response_session_command_post, session_id, 'put file', options)
 
     command_id = command['id']
     logging.debug("using command {}".format(command_id))
 
-    # check command status
+    # wait for the command to finish
+    command = await wait_for_command(session_id, command)
     status = command['status']
     logging.debug("command status is {}".format(status))
-    if status == 'pending':
-        return task.delay(10)
-    elif status == 'error':
+    if status == 'error':
         return task.fail("{} ({}): {}".format(command['result_type'], command['result_code'], command['result_desc']))
     elif status != 'complete':
         return task.delay(0)
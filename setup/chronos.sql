@@ -1,7 +1,13 @@
 CREATE DATABASE IF NOT EXISTS chronos;
 USE chronos;
 DROP TABLE IF EXISTS `tasks`;
+DROP TABLE IF EXISTS `locks`;
+DROP TABLE IF EXISTS `tasks_archive`;
+DROP TABLE IF EXISTS `task_summary`;
+DROP TABLE IF EXISTS `task_summary_delta`;
+DROP TABLE IF EXISTS `schema_version`;
 
+-- fresh install of the latest schema, existing databases are upgraded with chronos_migrate.py
 CREATE TABLE `tasks` (
     `id` binary(16) NOT NULL,
     `plugin` varchar(30) NOT NULL,
@@ -11,5 +17,89 @@ CREATE TABLE `tasks` (
     `modified` timestamp DEFAULT current_timestamp ON UPDATE current_timestamp,
     `created` timestamp NOT NULL,
     `locked_at` timestamp,
+    `claimed_by` varchar(128),
+    `claim_expires` timestamp NULL,
+    PRIMARY KEY (`id`),
+    KEY `idx_lock` (`status`, `lock_type`, `locked`, `created`, `modified`),
+    KEY `idx_claim` (`status`, `locked`, `created`, `modified`),
+    KEY `idx_claimed_by` (`claimed_by`),
+    KEY `idx_retention` (`status`, `plugin`, `modified`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `tasks_archive` (
+    `id` binary(16) NOT NULL,
+    `plugin` varchar(30) NOT NULL,
+    `lock_type` varchar(50),
+    `status` enum('queued', 'locked', 'running', 'complete', 'error', 'timed_out') NOT NULL,
+    `created` timestamp NOT NULL,
+    `modified` timestamp NULL,
+    `archived` timestamp NOT NULL DEFAULT current_timestamp,
     PRIMARY KEY (`id`)
 ) ENGINE=InnoDB;
+
+CREATE TABLE `locks` (
+    `id` binary(16) NOT NULL,
+    `lock_type` varchar(50) NOT NULL,
+    `granted` bool NOT NULL DEFAULT 0,
+    `created` timestamp NOT NULL DEFAULT current_timestamp,
+    `granted_at` timestamp NULL,
+    `kept_alive` timestamp NULL,
+    PRIMARY KEY (`id`),
+    KEY `idx_grant` (`lock_type`, `granted`, `created`),
+    KEY `idx_expire` (`lock_type`, `granted`, `kept_alive`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `task_summary` (
+    `status` enum('queued', 'locked', 'running', 'complete', 'error', 'timed_out') NOT NULL,
+    `lock_type` varchar(50) NOT NULL DEFAULT '',
+    `count` bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (`status`, `lock_type`)
+) ENGINE=InnoDB;
+
+CREATE TABLE `task_summary_delta` (
+    `id` bigint NOT NULL AUTO_INCREMENT,
+    `status` enum('queued', 'locked', 'running', 'complete', 'error', 'timed_out') NOT NULL,
+    `lock_type` varchar(50) NOT NULL DEFAULT '',
+    `delta` int NOT NULL,
+    PRIMARY KEY (`id`)
+) ENGINE=InnoDB;
+
+-- every change to tasks appends to task_summary_delta, the daemon folds it into task_summary
+DELIMITER //
+CREATE TRIGGER `tasks_summary_insert` AFTER INSERT ON `tasks`
+FOR EACH ROW
+BEGIN
+    INSERT INTO `task_summary_delta` (`status`, `lock_type`, `delta`) VALUES (NEW.status, COALESCE(NEW.lock_type, ''), 1);
+END//
+
+CREATE TRIGGER `tasks_summary_update` AFTER UPDATE ON `tasks`
+FOR EACH ROW
+BEGIN
+    IF NEW.status <> OLD.status OR NOT (NEW.lock_type <=> OLD.lock_type) THEN
+        INSERT INTO `task_summary_delta` (`status`, `lock_type`, `delta`) VALUES
+            (OLD.status, COALESCE(OLD.lock_type, ''), -1),
+            (NEW.status, COALESCE(NEW.lock_type, ''), 1);
+    END IF;
+END//
+
+CREATE TRIGGER `tasks_summary_delete` AFTER DELETE ON `tasks`
+FOR EACH ROW
+BEGIN
+    INSERT INTO `task_summary_delta` (`status`, `lock_type`, `delta`) VALUES (OLD.status, COALESCE(OLD.lock_type, ''), -1);
+END//
+DELIMITER ;
+
+CREATE TABLE `schema_version` (
+    `version` int NOT NULL,
+    `name` varchar(100) NOT NULL,
+    `applied` timestamp NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY (`version`)
+) ENGINE=InnoDB;
+
+INSERT INTO `schema_version` (`version`, `name`) VALUES
+    (1, 'create_tasks'),
+    (2, 'task_claims'),
+    (3, 'task_indexes'),
+    (4, 'locks'),
+    (5, 'retention'),
+    (6, 'task_summary');
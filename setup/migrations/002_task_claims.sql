@@ -0,0 +1,5 @@
+-- lets workers atomically claim batches of tasks under a lease
+ALTER TABLE `tasks`
+    ADD COLUMN `claimed_by` varchar(128),
+    ADD COLUMN `claim_expires` timestamp NULL,
+    ALGORITHM=INPLACE, LOCK=NONE;
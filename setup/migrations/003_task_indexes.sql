@@ -0,0 +1,8 @@
+-- idx_lock covers lock_oldest, select_locks, select_held and the counts of check_summary
+-- idx_claim covers claim_tasks and queue_running_tasks
+-- idx_claimed_by covers reading back and releasing claims
+ALTER TABLE `tasks`
+    ADD INDEX `idx_lock` (`status`, `lock_type`, `locked`, `created`, `modified`),
+    ADD INDEX `idx_claim` (`status`, `locked`, `created`, `modified`),
+    ADD INDEX `idx_claimed_by` (`claimed_by`),
+    ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,12 @@
+-- external locks are leases granted by the lock manager instead of tasks run by workers
+CREATE TABLE IF NOT EXISTS `locks` (
+    `id` binary(16) NOT NULL,
+    `lock_type` varchar(50) NOT NULL,
+    `granted` bool NOT NULL DEFAULT 0,
+    `created` timestamp NOT NULL DEFAULT current_timestamp,
+    `granted_at` timestamp NULL,
+    `kept_alive` timestamp NULL,
+    PRIMARY KEY (`id`),
+    KEY `idx_grant` (`lock_type`, `granted`, `created`),
+    KEY `idx_expire` (`lock_type`, `granted`, `kept_alive`)
+) ENGINE=InnoDB;
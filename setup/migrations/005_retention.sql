@@ -0,0 +1,16 @@
+-- finished tasks past their retention ttl are moved here in small batches by the daemon
+CREATE TABLE IF NOT EXISTS `tasks_archive` (
+    `id` binary(16) NOT NULL,
+    `plugin` varchar(30) NOT NULL,
+    `lock_type` varchar(50),
+    `status` enum('queued', 'locked', 'running', 'complete', 'error', 'timed_out') NOT NULL,
+    `created` timestamp NOT NULL,
+    `modified` timestamp NULL,
+    `archived` timestamp NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY (`id`)
+) ENGINE=InnoDB;
+
+-- idx_retention covers finding the oldest finished tasks of a plugin
+ALTER TABLE `tasks`
+    ADD INDEX `idx_retention` (`status`, `plugin`, `modified`),
+    ALGORITHM=INPLACE, LOCK=NONE;
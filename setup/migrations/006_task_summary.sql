@@ -0,0 +1,47 @@
+-- number of tasks per status and lock type so reading stats never scans tasks
+-- the triggers below only append +1/-1 rows to task_summary_delta in the same transaction as the change to tasks,
+-- appending never waits on another status change, the daemon folds the deltas into task_summary every
+-- summary_fold_interval and corrects any drift every summary_check_interval
+-- creating triggers needs the TRIGGER privilege, and SUPER or log_bin_trust_function_creators when binary logging is on
+CREATE TABLE IF NOT EXISTS `task_summary` (
+    `status` enum('queued', 'locked', 'running', 'complete', 'error', 'timed_out') NOT NULL,
+    `lock_type` varchar(50) NOT NULL DEFAULT '',
+    `count` bigint NOT NULL DEFAULT 0,
+    PRIMARY KEY (`status`, `lock_type`)
+) ENGINE=InnoDB;
+
+CREATE TABLE IF NOT EXISTS `task_summary_delta` (
+    `id` bigint NOT NULL AUTO_INCREMENT,
+    `status` enum('queued', 'locked', 'running', 'complete', 'error', 'timed_out') NOT NULL,
+    `lock_type` varchar(50) NOT NULL DEFAULT '',
+    `delta` int NOT NULL,
+    PRIMARY KEY (`id`)
+) ENGINE=InnoDB;
+
+DROP TRIGGER IF EXISTS `tasks_summary_insert`;
+DROP TRIGGER IF EXISTS `tasks_summary_update`;
+DROP TRIGGER IF EXISTS `tasks_summary_delete`;
+
+DELIMITER //
+CREATE TRIGGER `tasks_summary_insert` AFTER INSERT ON `tasks`
+FOR EACH ROW
+BEGIN
+    INSERT INTO `task_summary_delta` (`status`, `lock_type`, `delta`) VALUES (NEW.status, COALESCE(NEW.lock_type, ''), 1);
+END//
+
+CREATE TRIGGER `tasks_summary_update` AFTER UPDATE ON `tasks`
+FOR EACH ROW
+BEGIN
+    IF NEW.status <> OLD.status OR NOT (NEW.lock_type <=> OLD.lock_type) THEN
+        INSERT INTO `task_summary_delta` (`status`, `lock_type`, `delta`) VALUES
+            (OLD.status, COALESCE(OLD.lock_type, ''), -1),
+            (NEW.status, COALESCE(NEW.lock_type, ''), 1);
+    END IF;
+END//
+
+CREATE TRIGGER `tasks_summary_delete` AFTER DELETE ON `tasks`
+FOR EACH ROW
+BEGIN
+    INSERT INTO `task_summary_delta` (`status`, `lock_type`, `delta`) VALUES (OLD.status, COALESCE(OLD.lock_type, ''), -1);
+END//
+DELIMITER ;
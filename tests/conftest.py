@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# chronos reads its configuration from CHRONOS_HOME when first imported, point it at an empty home
+import chronos
+chronos.CHRONOS_HOME = tempfile.mkdtemp()
+os.makedirs(os.path.join(chronos.CHRONOS_HOME, "config"))
+with open(os.path.join(chronos.CHRONOS_HOME, "config", "logging.ini"), "w") as fh:
+    fh.write("[loggers]\nkeys=root\n\n[handlers]\nkeys=null\n\n[formatters]\nkeys=\n\n"
+             "[logger_root]\nhandlers=null\n\n[handler_null]\nclass=NullHandler\nargs=()\n")
+with open(os.path.join(chronos.CHRONOS_HOME, "config", "chronos.ini"), "w") as fh:
+    fh.write("[mysql]\nhost = localhost\ndb = chronos\nuser = chronos\npasswd = \n")
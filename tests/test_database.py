@@ -0,0 +1,139 @@
+import pytest
+
+pymysql = pytest.importorskip("pymysql")
+
+from chronos.database import Database, PoolTimeout
+from chronos.locks import LockAccounting
+
+class FakeCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, query, args=None):
+        self.connection.queries.append(query)
+        response = self.connection.responses.pop(0) if self.connection.responses else ([], 0)
+        if isinstance(response, Exception):
+            raise response
+        self.rows, self.rowcount = response
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+class FakeConnection(object):
+    # answers each query with the next of responses, a (rows, rowcount) pair or an exception to raise
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+class FakePool(object):
+    def __init__(self, *connections):
+        self.connections = list(connections)
+
+    def get(self):
+        if not self.connections:
+            raise PoolTimeout("no database connection available")
+        return self.connections.pop(0)
+
+    def put(self, conn, broken=False):
+        pass
+
+def database(*connections):
+    return Database(FakePool(*connections))
+
+def test_claim_tasks_round_trips():
+    db = database(FakeConnection([([], 2), ([("AB", "lock", "default", None), ("CD", "lock", "default", None)], 2)]))
+    tasks = db.claim_tasks("node:1:1", 5, 60)
+    assert len(tasks) == 2
+    assert db.round_trips == 2
+
+def test_claim_tasks_nothing_to_claim_round_trips():
+    db = database(FakeConnection([([], 0)]))
+    assert db.claim_tasks("node:1:1", 5, 60) == []
+    assert db.round_trips == 1
+
+def test_insert_tasks_round_trips():
+    db = database(FakeConnection([([], 3)]))
+    assert db.insert_tasks([("AB", "lock", "default"), ("CD", "lock", "default"), ("EF", "lock", "default")]) == 3
+    assert db.round_trips == 1
+
+def test_select_statuses_round_trips():
+    db = database(FakeConnection([([("AB", "complete", 0), ("CD", "queued", 0)], 2)]))
+    assert db.select_statuses(["AB", "CD"]) == {"AB":"complete", "CD":"queued"}
+    assert db.round_trips == 1
+
+def test_lock_round_trips():
+    # named lock, count of held locks, leases, tasks, release of the named lock
+    db = database(FakeConnection([([(1,)], 1), ([(0,)], 1), ([], 0), ([], 2), ([(1,)], 1)]))
+    assert LockAccounting().lock(db, "default", 2) == 2
+    assert db.round_trips == 5
+
+def test_check_summary_round_trips():
+    # isolation level, snapshot, tasks counts, summary counts, commit
+    connection = FakeConnection([([], 0), ([], 0), ([("queued", "default", 1)], 1), ([("queued", "default", 1)], 1)])
+    db = database(connection)
+    assert db.check_summary() == 0
+    assert db.round_trips == len(connection.queries) == 5
+    assert connection.queries[-1] == "COMMIT"
+
+def test_check_summary_drift_round_trips():
+    connection = FakeConnection([([], 0), ([], 0), ([("queued", "default", 2)], 1), ([("queued", "default", 1)], 1)])
+    db = database(connection)
+    assert db.check_summary() == 1
+    assert db.round_trips == len(connection.queries) == 6
+
+def test_fold_summary_round_trips():
+    # isolation level, start, deltas, one insert per status and lock type, delete, commit
+    deltas = [(1, "queued", "default", 1), (2, "queued", "default", -1), (3, "running", "default", 1)]
+    connection = FakeConnection([([], 0), ([], 0), (deltas, 3)])
+    db = database(connection)
+    assert db.fold_summary(10) == 3
+    assert db.round_trips == len(connection.queries) == 6
+    assert connection.queries[-1] == "COMMIT"
+
+def test_archive_tasks_round_trips():
+    # start, copy, delete, commit
+    connection = FakeConnection([([], 0), ([], 2), ([], 2), ([], 0)])
+    db = database(connection)
+    assert db.archive_tasks(["AB", "CD"]) == 2
+    assert db.round_trips == len(connection.queries) == 4
+    assert connection.queries[-1] == "COMMIT"
+
+def test_lost_archive_is_not_retried():
+    # the statements of a transaction are never run again on a new connection
+    lost = pymysql.err.OperationalError(2006, "MySQL server has gone away")
+    connection = FakeConnection([([], 0), ([], 2), lost])
+    db = database(connection, FakeConnection())
+    assert db.archive_tasks(["AB", "CD"]) == 0
+    assert db.round_trips == 4
+    assert db.in_transaction == False
+
+def test_lost_query_is_retried():
+    lost = pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+    db = database(FakeConnection([lost]), FakeConnection([([("complete",)], 1)]))
+    assert db.select_status("AB") == "complete"
+    assert db.round_trips == 2
+
+def test_lost_lock_query_is_not_retried():
+    # the server may already have locked the tasks, locking again could go over max_locks
+    lost = pymysql.err.OperationalError(2013, "Lost connection to MySQL server during query")
+    db = database(FakeConnection([lost]), FakeConnection([([], 1)]))
+    assert db.lock_oldest("default", 1) == 0
+    assert db.round_trips == 1
+
+def test_unsent_lock_query_is_retried():
+    gone = pymysql.err.OperationalError(2006, "MySQL server has gone away")
+    db = database(FakeConnection([gone]), FakeConnection([([], 1)]))
+    assert db.lock_oldest("default", 1) == 1
+    assert db.round_trips == 2
+
+def test_pool_timeout_is_raised():
+    with pytest.raises(PoolTimeout):
+        database()
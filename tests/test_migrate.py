@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+pymysql = pytest.importorskip("pymysql")
+
+from chronos import migrate
+from chronos.database import Database, STATUS_COMPLETE, STATUS_QUEUED, STATUS_RUNNING
+
+# the plans are checked against the database named by CHRONOS_TEST_DB, which the migrations are applied to
+# and filled with tasks, never point it at a database in use
+test_db = os.environ.get("CHRONOS_TEST_DB")
+
+class SingleConnectionPool(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get(self):
+        return self.connection
+
+    def put(self, conn, broken=False):
+        pass
+
+@pytest.fixture
+def db(monkeypatch):
+    if not test_db:
+        pytest.skip("CHRONOS_TEST_DB is not set")
+    connection = pymysql.connect(host=os.environ.get("CHRONOS_TEST_DB_HOST", "localhost"), db=test_db,
+        user=os.environ.get("CHRONOS_TEST_DB_USER", "chronos"), passwd=os.environ.get("CHRONOS_TEST_DB_PASSWD", ""),
+        charset='utf8', autocommit=True)
+    migrations_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "setup", "migrations")
+    monkeypatch.setattr(migrate, "migrations_dir", migrations_dir)
+    try:
+        with Database(SingleConnectionPool(connection)) as db:
+            migrate.migrate(db)
+
+            # the optimizer scans tables that are nearly empty, give it enough tasks to pick its real plans
+            c = db.connection.cursor()
+            c.execute("SELECT count(*) FROM tasks")
+            if c.fetchone()[0] < 10000:
+                statuses = [STATUS_COMPLETE] * 8 + [STATUS_QUEUED, STATUS_RUNNING]
+                rows = []
+                for index in range(10000):
+                    rows.extend((os.urandom(16), "explain", "default", statuses[index % len(statuses)]))
+                c.execute("""
+                    INSERT IGNORE INTO tasks (id, plugin, lock_type, status, created)
+                    VALUES {}
+                    """.format(", ".join(["(%s, %s, %s, %s, now())"] * 10000)), rows)
+            c.execute("ANALYZE TABLE tasks, locks")
+            c.fetchall()
+            yield db
+    finally:
+        connection.close()
+
+def test_hot_queries_use_indexes(db):
+    assert migrate.check_plans(db) == []